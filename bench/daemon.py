@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# run-radio.py with Config overrides from the command line:
+#   daemon.py key=value [key=value ...]
+# values are python literals, e.g. serial_dev=['/dev/pts/3'] mpd_port=6612
+# RADIO_SCRIPT runs another copy of run-radio.py, e.g. an older checkout
+
+import os
+import sys
+import ast
+import imp
+import signal
+
+script = os.environ.get('RADIO_SCRIPT') or os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'run-radio.py')
+radio = imp.load_source('radio', script)
+
+for arg in sys.argv[1:]:
+    key, value = arg.split('=', 1)
+    if not hasattr(radio.Config, key):
+        # an older run-radio.py lacks the newer settings
+        print "ignoring unknown Config." + key
+        continue
+    setattr(radio.Config, key, ast.literal_eval(value))
+
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+radio.setup_logging()
+radio.Program()
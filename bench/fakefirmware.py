@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Firmware stand-in on a pseudo terminal: answers init, the PV handshake and
+# protocol 2 frames like interface.ino does, and records every display write
+# as (time, slot, value).
+
+import os
+import pty
+import tty
+import threading
+import time
+
+
+class FakeFirmware:
+
+    def __init__(self, protocol=2):
+        self.protocol = protocol
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self.cond = threading.Condition()
+        self.writes = []
+        self.frames = 0
+        self.bad_frames = 0
+        self.last_seq = None
+        thread = threading.Thread(target=self.run, name="fakefirmware")
+        thread.daemon = True
+        thread.start()
+
+    def send(self, line):
+        # stamped before the write, an answer can arrive before write returns
+        sent = time.time()
+        os.write(self.master, line + "\r\n")
+        return sent
+
+    def init(self):
+        return self.send("init")
+
+    def encoder(self, value):
+        return self.send("E:%d" % value)
+
+    def volume(self, value):
+        return self.send("V:%d" % value)
+
+    def alarm(self, hours, minutes, on):
+        return self.send("A:%d:%d:%d" % (hours, minutes, 1 if on else 0))
+
+    def run(self):
+        data = ""
+        while True:
+            try:
+                chunk = os.read(self.master, 1024)
+            except OSError:
+                return
+            if not chunk:
+                return
+            data += chunk
+            while "\n" in data:
+                line, data = data.split("\n", 1)
+                self.process(line.strip(), time.time())
+
+    def process(self, line, now):
+        if line.startswith("PV:"):
+            if self.protocol >= 2:
+                self.send("PV:2")
+        elif line.startswith("#"):
+            self.process_frame(line, now)
+        elif line:
+            self.record(line, now)
+
+    def process_frame(self, line, now):
+        star = line.rfind("*")
+        body = line[1:star]
+        checksum = 0
+        for c in body:
+            checksum ^= ord(c)
+        seq = body[:2]
+        if star < 3 or line[star + 1:] != "%02X" % checksum:
+            self.bad_frames += 1
+            self.send("N:" + seq)
+            return
+        self.send("K:" + seq)
+        self.frames += 1
+        # a repeated frame means the ack was lost, it is not applied twice
+        if seq == self.last_seq:
+            return
+        self.last_seq = seq
+        payload = body[2:]
+        if payload.startswith("U:"):
+            rows = payload[2:].split("|")
+            for slot, value in zip(("S0", "S1", "S2", "TM"), rows):
+                self.record(slot + ":" + value, now)
+        else:
+            self.record(payload, now)
+
+    def record(self, line, now):
+        slot, sep, value = line.partition(":")
+        with self.cond:
+            self.writes.append((now, slot, value))
+            self.cond.notify_all()
+
+    def count(self, since=0):
+        with self.cond:
+            return len([write for write in self.writes if write[0] >= since])
+
+    def wait_for(self, slot, value, since=0, timeout=10):
+        # time of the first write of value to slot after since, None on timeout
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                for t, written, text in self.writes:
+                    if t >= since and written == slot and text == value:
+                        return t
+                left = deadline - time.time()
+                if left <= 0:
+                    return None
+                self.cond.wait(left)
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Minimal in-process MPD stand-in: enough of the protocol for run-radio.py
+# (queue commands, command lists, idle/noidle), every command is recorded
+# with a timestamp. latency and delays hold each answer back, as the round
+# trips of a real mpd would.
+
+import socket
+import select
+import threading
+import time
+
+
+class FakeMPD:
+
+    version = "0.19.0"
+
+    def __init__(self, port=0):
+        self.port = port
+        self.lock = threading.Condition()
+        self.queue = []
+        self.next_id = 1
+        self.current = None
+        self.state = 'stop'
+        self.volume = 100
+        self.title = ''
+        self.started = 0
+        self.stalled = None
+        self.changes = 0
+        self.commands = []
+        self.plays = []
+        self.listener = None
+        self.clients = []
+        self.latency = 0
+        self.delays = {}
+
+    def start(self):
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', self.port))
+        self.listener.listen(8)
+        # port 0 picks a free one, a restart binds the same one again
+        self.port = self.listener.getsockname()[1]
+        thread = threading.Thread(target=self.accept, args=(self.listener,), name="fakempd")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        # drops every connection, as a crashed or restarting mpd would
+        if self.listener is not None:
+            # shutdown wakes the accept thread, which holds the socket open
+            try:
+                self.listener.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.listener.close()
+            self.listener = None
+        with self.lock:
+            clients = self.clients
+            self.clients = []
+            self.lock.notify_all()
+        for client in clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+                client.close()
+            except socket.error:
+                pass
+
+    def accept(self, listener):
+        while True:
+            try:
+                client, address = listener.accept()
+            except socket.error:
+                return
+            with self.lock:
+                self.clients.append(client)
+            thread = threading.Thread(target=self.serve, args=(client,), name="fakempd-client")
+            thread.daemon = True
+            thread.start()
+
+    def stop_player(self):
+        # as after a reboot of the whole box: queue kept, nothing playing
+        with self.lock:
+            self.state = 'stop'
+            self.current = None
+
+    def stall(self):
+        # the stream stops delivering audio, mpd stays in play
+        with self.lock:
+            self.stalled = time.time()
+
+    def set_title(self, title):
+        # titles from a json trace are unicode, mpd speaks utf-8
+        if isinstance(title, unicode):
+            title = title.encode('utf-8')
+        with self.lock:
+            self.title = title
+            self.changed()
+
+    def changed(self):
+        self.changes += 1
+        self.lock.notify_all()
+
+    def plays_since(self, since):
+        with self.lock:
+            return [(t, pos) for t, pos in self.plays if t >= since]
+
+    def current_file(self):
+        with self.lock:
+            pos = self.position(self.current)
+            return pos is not None and self.queue[pos][1] or None
+
+    def commands_since(self, name, since):
+        with self.lock:
+            return [(t, args) for t, command, args in self.commands if t >= since and command == name]
+
+    def wait_play(self, pos, since=0, timeout=10):
+        # time of the first play of queue position pos after since, None on timeout
+        deadline = time.time() + timeout
+        with self.lock:
+            while True:
+                for t, played in self.plays:
+                    if t >= since and played == pos:
+                        return t
+                left = deadline - time.time()
+                if left <= 0:
+                    return None
+                self.lock.wait(left)
+
+    def serve(self, client):
+        rfile = client.makefile('rb', 0)
+        try:
+            client.sendall("OK MPD %s\n" % self.version)
+            batch = None
+            list_ok = False
+            while True:
+                line = rfile.readline()
+                if not line:
+                    return
+                command, args = self.split(line.strip())
+                if command in ('command_list_begin', 'command_list_ok_begin'):
+                    batch = []
+                    list_ok = command == 'command_list_ok_begin'
+                elif command == 'command_list_end':
+                    out = []
+                    error = None
+                    for command, args in batch:
+                        error = self.run(command, args, out)
+                        if error:
+                            break
+                        if list_ok:
+                            out.append("list_OK\n")
+                    self.delay([command for command, args in batch])
+                    batch = None
+                    client.sendall("".join(out) + (error or "OK\n"))
+                elif batch is not None:
+                    batch.append((command, args))
+                elif command == 'idle':
+                    client.sendall(self.idle(client, rfile))
+                elif command == 'close':
+                    return
+                else:
+                    out = []
+                    error = self.run(command, args, out)
+                    self.delay([command])
+                    client.sendall("".join(out) + (error or "OK\n"))
+        except socket.error:
+            pass
+        finally:
+            with self.lock:
+                if client in self.clients:
+                    self.clients.remove(client)
+            client.close()
+
+    def delay(self, commands):
+        # one round trip per request, a command list waits for its slowest
+        delay = max([self.delays.get(command, self.latency) for command in commands] or [0])
+        if delay > 0:
+            time.sleep(delay)
+
+    def split(self, line):
+        command, sep, rest = line.partition(' ')
+        args = []
+        while rest:
+            rest = rest.lstrip()
+            if rest.startswith('"'):
+                end = rest.index('"', 1)
+                args.append(rest[1:end])
+                rest = rest[end + 1:]
+            else:
+                arg, sep, rest = rest.partition(' ')
+                args.append(arg)
+        return command, args
+
+    def idle(self, client, rfile):
+        # answers at the next change, or right away on noidle
+        with self.lock:
+            seen = self.changes
+        while True:
+            readable, _, _ = select.select([client], [], [], 0.02)
+            if readable:
+                rfile.readline()
+                return "OK\n"
+            with self.lock:
+                if self.changes != seen:
+                    return "changed: player\nOK\n"
+                if client not in self.clients:
+                    raise socket.error("stopped")
+
+    def song(self, pos):
+        songid, url = self.queue[pos]
+        text = "file: %s\nPos: %d\nId: %d\n" % (url, pos, songid)
+        if songid == self.current and self.title:
+            text += "Title: %s\n" % self.title
+        return text
+
+    def position(self, songid):
+        for pos, (queued, url) in enumerate(self.queue):
+            if queued == songid:
+                return pos
+        return None
+
+    def run(self, command, args, out):
+        now = time.time()
+        with self.lock:
+            self.commands.append((now, command, args))
+            if command == 'currentsong':
+                pos = self.position(self.current)
+                if pos is not None:
+                    out.append(self.song(pos))
+            elif command == 'status':
+                out.append("volume: %d\nstate: %s\n" % (self.volume, self.state))
+                if self.current is not None:
+                    out.append("songid: %d\n" % self.current)
+                if self.state == 'play':
+                    elapsed = (self.stalled or now) - self.started
+                    out.append("elapsed: %.3f\nbitrate: 128\n" % elapsed)
+            elif command == 'playlistinfo':
+                positions = range(len(self.queue))
+                if args:
+                    positions = [int(args[0])] if int(args[0]) < len(self.queue) else []
+                out.extend(self.song(pos) for pos in positions)
+            elif command == 'playlistfind':
+                out.extend(self.song(pos) for pos, (songid, url) in enumerate(self.queue) if args == ['file', url])
+            elif command in ('add', 'addid'):
+                pos = len(self.queue)
+                if len(args) > 1:
+                    pos = int(args[1])
+                self.queue.insert(pos, (self.next_id, args[0]))
+                if command == 'addid':
+                    out.append("Id: %d\n" % self.next_id)
+                self.next_id += 1
+            elif command == 'deleteid':
+                pos = self.position(int(args[0]))
+                if pos is None:
+                    return "ACK [50@0] {deleteid} No such song\n"
+                del self.queue[pos]
+            elif command == 'moveid':
+                pos = self.position(int(args[0]))
+                if pos is None:
+                    return "ACK [50@0] {moveid} No such song\n"
+                self.queue.insert(int(args[1]), self.queue.pop(pos))
+            elif command == 'clear':
+                self.queue = []
+                self.current = None
+            elif command == 'stop':
+                self.state = 'stop'
+            elif command in ('play', 'playid'):
+                if command == 'play':
+                    pos = int(args[0]) if args else 0
+                else:
+                    pos = self.position(int(args[0]))
+                if pos is None or pos >= len(self.queue):
+                    return "ACK [50@0] {%s} No such song\n" % command
+                self.current = self.queue[pos][0]
+                self.state = 'play'
+                self.started = now
+                self.stalled = None
+                self.plays.append((now, pos))
+                self.changed()
+            elif command == 'setvol':
+                self.volume = int(args[0])
+                self.changed()
+        return None
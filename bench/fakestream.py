@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Stand-in for the station stream servers: any path is an endless stream of
+# filler audio at a fixed byte rate, with icy metadata when asked for.
+# Every connection and disconnection is recorded with a timestamp, drop()
+# cuts the open connections of a path as a failing upstream would.
+
+import socket
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+
+
+class StreamHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        stream = self.server.stream
+        metaint = 0
+        if self.headers.getheader('Icy-MetaData') == '1':
+            metaint = stream.metaint
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/mpeg')
+        if metaint:
+            self.send_header('icy-metaint', str(metaint))
+        self.end_headers()
+        stream.opened(self.path, self.connection)
+        try:
+            self.stream(stream, metaint)
+        except socket.error:
+            pass
+        finally:
+            stream.closed(self.path, self.connection)
+
+    def stream(self, stream, metaint):
+        chunk = "\xff" * stream.chunk
+        left = metaint
+        sent = 0
+        started = time.time()
+        while stream.running:
+            data = chunk
+            while data:
+                part = data[:left] if metaint else data
+                self.wfile.write(part)
+                data = data[len(part):]
+                if metaint:
+                    left -= len(part)
+                    if left == 0:
+                        meta = "StreamTitle='%s';" % self.path.strip('/')
+                        meta += "\0" * (-len(meta) % 16)
+                        self.wfile.write(chr(len(meta) / 16) + meta)
+                        left = metaint
+            sent += len(chunk)
+            delay = started + sent / float(stream.rate) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StreamServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # a client hanging up mid-stream is the normal way a stream ends
+        pass
+
+
+class FakeStream:
+
+    def __init__(self, rate=16000, chunk=1024, metaint=8192):
+        self.rate = rate
+        self.chunk = chunk
+        self.metaint = metaint
+        self.lock = threading.Condition()
+        self.connections = []
+        self.disconnections = []
+        self.active = {}
+        self.running = False
+        self.server = None
+        self.port = None
+
+    def start(self):
+        self.running = True
+        self.server = StreamServer(('127.0.0.1', 0), StreamHandler)
+        self.server.stream = self
+        self.port = self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever, name="fakestream")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def url(self, path):
+        return "http://127.0.0.1:%d/%s" % (self.port, path)
+
+    def opened(self, path, conn):
+        with self.lock:
+            self.connections.append((time.time(), path))
+            self.active.setdefault(path, set()).add(conn)
+            self.lock.notify_all()
+
+    def closed(self, path, conn):
+        with self.lock:
+            self.disconnections.append((time.time(), path))
+            self.active.get(path, set()).discard(conn)
+            self.lock.notify_all()
+
+    def drop(self, path):
+        # the connections of path end as if the server went away
+        with self.lock:
+            conns = list(self.active.get(path, ()))
+        for conn in conns:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        return time.time()
+
+    def open_count(self, path):
+        with self.lock:
+            return len(self.active.get(path, ()))
+
+    def connects_since(self, path, since):
+        with self.lock:
+            return [t for t, opened in self.connections if opened == path and t >= since]
+
+    def wait(self, check, timeout=10):
+        # time at which check() first held, None on timeout
+        deadline = time.time() + timeout
+        with self.lock:
+            while not check():
+                left = deadline - time.time()
+                if left <= 0:
+                    return None
+                self.lock.wait(left)
+            return time.time()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Replays a trace recorded with Config.trace into run-radio.py running
+# against the fake firmware and the fake MPD, and reports how the daemon
+# reacted. The serial input (encoder, volume and alarm lines, init requests)
+# goes to the fake firmware, the recorded title changes to the fake MPD,
+# which answers with the median round trips the trace recorded.
+#
+#   replay.py trace.jsonl [--speed 10] [--max-gap 5] [--radio old/run-radio.py]
+#             [--json out.json] [--baseline old.json] [--record replayed.jsonl]
+#             [--serial-only]
+#
+# Inputs go out on deadlines computed from the trace timestamps, so the same
+# trace at the same speed always drives the daemon with the same timing.
+# --speed compresses every gap, --max-gap cuts long idle stretches first.
+# bench/fixtures holds small sample traces, e.g. cyrillic-titles.jsonl.
+
+import os
+import sys
+import time
+import json
+import socket
+import urllib2
+import argparse
+import collections
+
+from imp import load_source
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+bench = load_source('run_bench', os.path.join(BENCH_DIR, 'run-bench.py'))
+
+# firmware lines the fake firmware produces on its own
+ANSWERS = ('K:', 'N:', 'PV:')
+
+# recorded MPDWrapper.execute names -> the mpd command that takes the round
+# trip in the fake MPD; currentsong is a single round trip and sets the
+# latency of everything else
+ROUND_TRIPS = {'currentsong': 'currentsong', 'status': 'status', 'setvol': 'setvol', 'play': 'play'}
+
+# a title fetched this soon after an idle change changed at the idle change
+IDLE_WINDOW = 1.0
+
+
+def load_trace(filename):
+    # (stations, active station, protocol, [(t, 'rx' or 'title', line or
+    # title)], {mpd command: [round trip seconds]})
+    stations = None
+    active = 0
+    protocol = 1
+    inputs = []
+    round_trips = collections.defaultdict(list)
+    last_idle = None
+    fsrc = open(filename)
+    for ln in fsrc:
+        event = json.loads(ln)
+        kind = event['k']
+        t = event['t']
+        if kind == 'start' and event['d'].get('rotated'):
+            # the PV: answer is in the older file
+            protocol = event['d']['protocol']
+        elif kind == 'playlist' and stations is None:
+            stations = event['d']['stations']
+            active = event['d']['active']
+        elif kind == 'rx':
+            line = event['d']
+            if line.startswith('PV:'):
+                protocol = 2
+            if line and not line.startswith(ANSWERS):
+                inputs.append((t, 'rx', line))
+        elif kind == 'idle':
+            last_idle = t
+        elif kind == 'title':
+            if last_idle is not None and t - last_idle < IDLE_WINDOW:
+                t = last_idle
+            inputs.append((t, 'title', event['d']))
+        elif kind == 'mpd' and 'ms' in event['d'] and event['d']['cmd'] in ROUND_TRIPS:
+            round_trips[ROUND_TRIPS[event['d']['cmd']]].append(event['d']['ms'] / 1000.0)
+    fsrc.close()
+    inputs.sort(key=lambda item: item[0])
+    if stations is None:
+        targets = [int(line[2:]) for t, kind, line in inputs if kind == 'rx' and line.startswith('E:')]
+        stations = max(targets + [active]) + 1
+    return stations, active, protocol, inputs, round_trips
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def histogram(text, name):
+    # (cumulative count per upper bound, sum, count) from the metrics page
+    buckets = []
+    total = count = 0
+    for ln in text.splitlines():
+        if ln.startswith(name + '_bucket{le="') and '+Inf' not in ln:
+            bound = ln.split('"')[1]
+            buckets.append((float(bound), int(ln.split()[-1])))
+        elif ln.startswith(name + '_sum'):
+            total = float(ln.split()[-1])
+        elif ln.startswith(name + '_count'):
+            count = int(ln.split()[-1])
+    return buckets, total, count
+
+
+def bucket_percentile(buckets, count, fraction):
+    for bound, cumulative in buckets:
+        if cumulative >= fraction * count:
+            return bound
+    return None
+
+
+def set_round_trips(mpd, round_trips):
+    for command, samples in round_trips.items():
+        mpd.delays[command] = bench.percentile(samples, 0.5)
+    mpd.latency = mpd.delays.get('currentsong', 0)
+
+
+def feed(run, inputs, speed, max_gap):
+    # [(time sent, serial line)]
+    sent = []
+    deadline = time.time()
+    last = None
+    for t, kind, line in inputs:
+        if last is not None:
+            gap = t - last
+            if max_gap:
+                gap = min(gap, max_gap)
+            deadline += gap / speed
+        last = t
+        delay = deadline - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        if kind == 'title':
+            run.mpd.set_title(line)
+        else:
+            sent.append((run.firmware.send(line), line))
+    return sent
+
+
+def analyse(run, sent):
+    encoders = [(t, int(line[2:])) for t, line in sent if line.startswith('E:')]
+    plays = sorted(run.mpd.plays_since(encoders[0][0] if encoders else 0))
+    shown = []
+    played = []
+    coalesced = 0
+    for t, target in encoders:
+        display = run.firmware.wait_for("S0", bench.station_row(target), t, 0)
+        if display is None:
+            coalesced += 1
+        else:
+            shown.append(display - t)
+        # a later move before the play supersedes this one
+        after = [play for play in plays if play[0] >= t]
+        if after and after[0][1] == target:
+            played.append(after[0][0] - t)
+    volumes = [line for t, line in sent if line.startswith('V:')]
+    setvols = run.mpd.commands_since('setvol', sent[0][0] if sent else 0)
+    return {
+        'encoder_events': len(encoders),
+        'encoder_to_display_ms': bench.ms(bench.percentile(shown, 0.5)),
+        'encoder_to_display_p95_ms': bench.ms(bench.percentile(shown, 0.95)),
+        'encoder_to_display_max_ms': bench.ms(max(shown) if shown else None),
+        'displays_coalesced': coalesced,
+        'encoder_to_play_ms': bench.ms(bench.percentile(played, 0.5)),
+        'encoder_to_play_p95_ms': bench.ms(bench.percentile(played, 0.95)),
+        'encoder_to_play_max_ms': bench.ms(max(played) if played else None),
+        'plays': len(plays),
+        'volume_events': len(volumes),
+        'setvol_commands': len(setvols),
+    }
+
+
+def loop_metrics(port):
+    try:
+        text = urllib2.urlopen("http://127.0.0.1:%d/metrics" % port, timeout=5).read()
+    except (IOError, socket.error) as e:
+        print "metrics unavailable: %s" % e
+        return {}
+    buckets, total, count = histogram(text, "radio_loop_iteration_seconds")
+    if not count:
+        return {}
+    return {
+        'loop_work_mean_ms': bench.ms(total / count),
+        'loop_work_p95_ms': bench.ms(bucket_percentile(buckets, count, 0.95)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay a run-radio.py trace")
+    parser.add_argument("trace")
+    parser.add_argument("--speed", type=float, default=1.0, help="time compression, 10 plays the trace ten times as fast")
+    parser.add_argument("--max-gap", type=float, default=0, help="cut gaps between inputs to this many seconds before --speed")
+    parser.add_argument("--radio", help="run-radio.py to replay against, default the one in this tree")
+    parser.add_argument("--record", help="trace the replayed run into this file")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare against results saved with --json")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--keep", action="store_true", help="keep the temp directory with the daemon log")
+    parser.add_argument("--serial-only", action="store_true", help="replay only the serial input, no titles and no mpd round trips")
+    args = parser.parse_args()
+
+    stations, active, protocol, inputs, round_trips = load_trace(args.trace)
+    if args.serial_only:
+        inputs = [item for item in inputs if item[1] == 'rx']
+        round_trips = {}
+    if not [item for item in inputs if item[1] == 'rx']:
+        sys.exit("no serial input in " + args.trace)
+    if args.radio:
+        os.environ['RADIO_SCRIPT'] = os.path.abspath(args.radio)
+    titles = len([item for item in inputs if item[1] == 'title'])
+    print "replaying %d inputs and %d titles over %d stations, protocol %d" % (len(inputs) - titles, titles, stations, protocol)
+
+    run = bench.Bench(stations, protocol, args.keep)
+    set_round_trips(run.mpd, round_trips)
+    if run.mpd.latency:
+        print "mpd round trip %.1f ms" % (run.mpd.latency * 1000)
+    fstate = open(os.path.join(run.dir, "state.txt"), "w")
+    fstate.write("%d:7:0:0\n" % active)
+    fstate.close()
+    port = free_port()
+    run.extra['metrics_port'] = port
+    if args.record:
+        run.extra['trace'] = os.path.abspath(args.record)
+    try:
+        run.start()
+        run.wait_ready(station=active)
+        measure = bench.Measure(run)
+        sent = feed(run, inputs, args.speed, args.max_gap)
+        # let the last switch settle and play
+        time.sleep(3)
+        results = measure.result(analyse(run, sent))
+        results.update(loop_metrics(port))
+    finally:
+        run.close()
+
+    for metric, value in sorted(results.items()):
+        print "%-32s %s" % (metric, value)
+
+    if args.json:
+        fdst = open(args.json, "w")
+        json.dump({'replay': results}, fdst, indent=2, sort_keys=True)
+        fdst.close()
+
+    if args.baseline:
+        fsrc = open(args.baseline)
+        baseline = json.load(fsrc)
+        fsrc.close()
+        regressions = bench.compare({'replay': results}, baseline, args.tolerance)
+        for line in regressions:
+            print "regression: " + line
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
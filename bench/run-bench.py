@@ -0,0 +1,491 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Benchmark and load scenarios for run-radio.py, off the device: the daemon
+# runs as a child process against a fake firmware on a pty and a fake MPD.
+#
+#   run-bench.py [-s scenario ...] [--json out.json] [--baseline old.json]
+#
+# Every metric is lower-is-better, with --baseline anything more than
+# --tolerance worse than the saved run is reported and the exit code is 1.
+
+import os
+import sys
+import time
+import json
+import shutil
+import signal
+import socket
+import urllib
+import urllib2
+import argparse
+import tempfile
+import subprocess
+
+from fakempd import FakeMPD
+from fakefirmware import FakeFirmware
+from fakestream import FakeStream
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def ms(seconds):
+    if seconds is None:
+        return None
+    return round(seconds * 1000, 1)
+
+
+def station_name(idx):
+    return "Station %04d" % idx
+
+
+def station_row(idx):
+    # what the daemon shows in S0 for the station
+    return station_name(idx).upper()
+
+
+class Bench:
+
+    def __init__(self, stations=240, protocol=2, keep=False):
+        self.stations = stations
+        self.keep = keep
+        self.dir = tempfile.mkdtemp(prefix="radio-bench-")
+        self.playlist = os.path.join(self.dir, "radio.m3u")
+        self.write_playlist(stations)
+        fstate = open(os.path.join(self.dir, "state.txt"), "w")
+        fstate.write("0:7:0:0\n")
+        fstate.close()
+        self.mpd = FakeMPD()
+        self.mpd.start()
+        self.firmware = FakeFirmware(protocol)
+        self.process = None
+        self.started = 0
+        # more Config overrides, on top of config()
+        self.extra = {}
+
+    def write_playlist(self, stations, base="http://127.0.0.1:9"):
+        # nothing listens on the discard port unless a scenario serves streams
+        fdst = open(self.playlist, "w")
+        fdst.write("#EXTM3U\n")
+        for idx in range(stations):
+            # a mirror ahead of the primary url, the last one of an entry
+            fdst.write("#EXTINF:-1,%s\n%s/mirror/%04d\n%s/station/%04d\n" % (station_name(idx), base, idx, base, idx))
+        fdst.close()
+
+    def config(self):
+        return {
+            'serial_dev': [self.firmware.path],
+            'protocol': self.firmware.protocol,
+            'playlist': self.playlist,
+            'playlist_cache': os.path.join(self.dir, "radio.m3u.cache"),
+            'state': os.path.join(self.dir, "state.txt"),
+            'alarm': os.path.join(self.dir, "alarm.txt"),
+            'history': os.path.join(self.dir, "history.log"),
+            'mirrors': os.path.join(self.dir, "mirrors.json"),
+            'probe': False,
+            'probe_index': os.path.join(self.dir, "probe.json"),
+            'relay': False,
+            'mpd_host': "127.0.0.1",
+            'mpd_port': self.mpd.port,
+            'stats_interval': 3600,
+            'log_file': None,
+        }
+
+    def start(self):
+        args = [sys.executable, "-u", os.path.join(BENCH_DIR, "daemon.py")]
+        config = self.config()
+        config.update(self.extra)
+        args += ["%s=%r" % item for item in sorted(config.items())]
+        self.log = open(os.path.join(self.dir, "daemon.log"), "a")
+        self.started = time.time()
+        self.process = subprocess.Popen(args, stdout=self.log, stderr=subprocess.STDOUT, close_fds=True)
+        return self.started
+
+    def wait_ready(self, timeout=30, station=0):
+        # the first station row on the display means the main loop runs
+        ready = self.firmware.wait_for("S0", station_row(station), self.started, timeout)
+        if ready is None:
+            raise RuntimeError("daemon did not come up, see " + self.log.name)
+        return ready
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            deadline = time.time() + 5
+            while self.process.poll() is None and time.time() < deadline:
+                time.sleep(0.05)
+            if self.process.poll() is None:
+                self.process.kill()
+                self.process.wait()
+        self.process = None
+
+    def close(self):
+        self.stop()
+        self.mpd.stop()
+        self.log.close()
+        if self.keep:
+            print "kept " + self.dir
+        else:
+            shutil.rmtree(self.dir, True)
+
+    def cpu_seconds(self):
+        fstat = open("/proc/%d/stat" % self.process.pid)
+        fields = fstat.read().rsplit(")", 1)[1].split()
+        fstat.close()
+        # utime and stime, fields 14 and 15 of proc(5)
+        return (int(fields[11]) + int(fields[12])) / float(CLOCK_TICKS)
+
+    def peak_rss(self):
+        fstatus = open("/proc/%d/status" % self.process.pid)
+        try:
+            for line in fstatus:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+        finally:
+            fstatus.close()
+        return None
+
+    def move(self, target, timeout=5):
+        # encoder to target, then (to display, to play) latency in seconds
+        sent = self.firmware.encoder(target)
+        shown = self.firmware.wait_for("S0", station_row(target), sent, timeout)
+        played = self.mpd.wait_play(target, sent, timeout)
+        return (shown and shown - sent, played and played - sent)
+
+
+class Measure:
+
+    # cpu and peak rss of the daemon over a scenario body
+
+    def __init__(self, bench):
+        self.bench = bench
+        self.cpu = bench.cpu_seconds()
+        self.started = time.time()
+
+    def result(self, metrics):
+        elapsed = time.time() - self.started
+        cpu = self.bench.cpu_seconds() - self.cpu
+        metrics['cpu_per_min_ms'] = ms(cpu * 60 / elapsed)
+        metrics['peak_rss_kb'] = self.bench.peak_rss()
+        return metrics
+
+
+def scenario_idle(bench):
+    # nothing happens, the loop should sleep between clock ticks
+    bench.start()
+    bench.wait_ready()
+    time.sleep(1)
+    measure = Measure(bench)
+    writes = bench.firmware.count(time.time())
+    time.sleep(10)
+    return measure.result({'serial_writes': bench.firmware.count(measure.started) - writes})
+
+
+def scenario_startup(bench):
+    started = bench.start()
+    shown = bench.wait_ready()
+    played = bench.mpd.wait_play(0, started, 30)
+    return {
+        'boot_to_play_ms': ms(played and played - started),
+        'boot_to_display_ms': ms(shown - started),
+        'peak_rss_kb': bench.peak_rss(),
+    }
+
+
+def scenario_encoder(bench):
+    # single steps, each one settles before the next
+    bench.start()
+    bench.wait_ready()
+    measure = Measure(bench)
+    shown = []
+    played = []
+    for target in range(1, 11):
+        to_display, to_play = bench.move(target)
+        shown.append(to_display)
+        played.append(to_play)
+        time.sleep(0.2)
+    return measure.result({
+        'encoder_to_display_ms': ms(percentile(filter(None, shown), 0.5)),
+        'encoder_to_display_max_ms': ms(max(shown)),
+        'encoder_to_play_ms': ms(percentile(filter(None, played), 0.5)),
+        'encoder_to_play_max_ms': ms(max(played)),
+        'missed': shown.count(None) + played.count(None),
+    })
+
+
+def scenario_spin(bench):
+    # a fast spin over 40 stations, only the last one should be played
+    bench.start()
+    bench.wait_ready()
+    measure = Measure(bench)
+    spin_started = time.time()
+    for target in range(1, 41):
+        sent = bench.firmware.encoder(target)
+        time.sleep(0.015)
+    shown = bench.firmware.wait_for("S0", station_row(40), sent, 5)
+    played = bench.mpd.wait_play(40, sent, 5)
+    time.sleep(1)
+    return measure.result({
+        'last_encoder_to_display_ms': ms(shown and shown - sent),
+        'last_encoder_to_play_ms': ms(played and played - sent),
+        'plays': len(bench.mpd.plays_since(spin_started)),
+        'serial_writes': bench.firmware.count(spin_started),
+    })
+
+
+def scenario_churn(bench):
+    # stream titles changing every 50 ms for 5 s
+    bench.start()
+    bench.wait_ready()
+    measure = Measure(bench)
+    churn_started = time.time()
+    titles = []
+    for idx in range(100):
+        title = "Song %d" % idx
+        titles.append((time.time(), title.upper()))
+        bench.mpd.set_title(title)
+        time.sleep(0.05)
+    time.sleep(1)
+    latencies = []
+    for changed, text in titles:
+        shown = bench.firmware.wait_for("S2", text, changed, 0)
+        if shown is not None:
+            latencies.append(shown - changed)
+    return measure.result({
+        'title_to_display_ms': ms(percentile(latencies, 0.5)),
+        'title_to_display_p95_ms': ms(percentile(latencies, 0.95)),
+        'titles_skipped': len(titles) - len(latencies),
+        'serial_writes': bench.firmware.count(churn_started),
+    })
+
+
+def scenario_drop(bench):
+    # mpd goes away for 2 s while the encoder moves, the play waits for it
+    bench.start()
+    bench.wait_ready()
+    time.sleep(0.5)
+    measure = Measure(bench)
+    bench.mpd.stop()
+    time.sleep(0.2)
+    sent = bench.firmware.encoder(5)
+    shown = bench.firmware.wait_for("S0", station_row(5), sent, 5)
+    time.sleep(2)
+    restarted = time.time()
+    bench.mpd.start()
+    played = bench.mpd.wait_play(5, restarted, 60)
+    after = bench.move(6)
+    return measure.result({
+        'encoder_to_display_offline_ms': ms(shown and shown - sent),
+        'restart_to_play_ms': ms(played and played - restarted),
+        'encoder_to_play_after_ms': ms(after[1]),
+    })
+
+
+def scenario_stall(bench):
+    # the upstream stalls twice: the watchdog moves to the mirror at once,
+    # after that every url has failed and the retry waits for the backoff
+    bench.start()
+    bench.wait_ready()
+    time.sleep(2)
+    measure = Measure(bench)
+    metrics = {}
+    for name in ('failover', 'backoff'):
+        before = bench.mpd.current_file()
+        stalled = time.time()
+        bench.mpd.stall()
+        played = bench.mpd.wait_play(0, stalled, 30)
+        metrics['stall_to_' + name + '_ms'] = ms(played and played - stalled)
+        if bench.mpd.current_file() == before:
+            metrics['same_url_' + name] = 1
+        time.sleep(2)
+    return measure.result(metrics)
+
+
+def scenario_volume(bench):
+    # the knob swept over its range in 2 s, with an encoder step half way:
+    # setvol is coalesced and the station switch is not held up by it
+    bench.start()
+    bench.wait_ready()
+    time.sleep(0.5)
+    measure = Measure(bench)
+    knob_started = time.time()
+    moved = None
+    for value in range(0, 101):
+        turned = bench.firmware.volume(value)
+        if value == 50:
+            moved = bench.firmware.encoder(1)
+        time.sleep(0.02)
+    played = bench.mpd.wait_play(1, moved, 5)
+    time.sleep(1)
+    setvols = bench.mpd.commands_since('setvol', knob_started)
+    return measure.result({
+        'setvol_commands': len(setvols),
+        'last_knob_to_setvol_ms': ms(setvols and setvols[-1][0] - turned),
+        'final_volume_wrong': int(not setvols or setvols[-1][1] != ['100']),
+        'encoder_to_play_ms': ms(played and played - moved),
+    })
+
+
+def scenario_big(bench):
+    # large playlist, cold start without and warm start with the parse cache
+    metrics = {}
+    for name in ('cold', 'warm'):
+        started = bench.start()
+        shown = bench.wait_ready(60)
+        played = bench.mpd.wait_play(0, started, 60)
+        metrics[name + '_boot_to_play_ms'] = ms(played and played - started)
+        metrics[name + '_boot_to_display_ms'] = ms(shown - started)
+        if name == 'cold':
+            time.sleep(1)
+            bench.stop()
+            bench.mpd.stop_player()
+    # the first frame on the display may still wait for its ack
+    time.sleep(0.5)
+    measure = Measure(bench)
+    to_display, to_play = bench.move(bench.stations - 1)
+    metrics['encoder_to_display_ms'] = ms(to_display)
+    metrics['encoder_to_play_ms'] = ms(to_play)
+    return measure.result(metrics)
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def relay_client(port, url):
+    # a player on the relay: (seconds to the first audio bytes, response)
+    started = time.time()
+    response = urllib2.urlopen("http://127.0.0.1:%d/%s" % (port, urllib.quote(url, safe='')), timeout=5)
+    response.read(4096)
+    return time.time() - started, response
+
+
+def scenario_relay(bench):
+    # the relay against stand-in stream servers: the active station and its
+    # neighbours are warmed, players fan out from one upstream, a switch lets
+    # the stations left behind expire, a dropped upstream reconnects
+    streams = FakeStream()
+    streams.start()
+    relay_port = free_port()
+    bench.write_playlist(bench.stations, "http://127.0.0.1:%d" % streams.port)
+    bench.extra.update({'relay': True, 'relay_port': relay_port, 'relay_idle': 2, 'relay_neighbours': 1})
+    try:
+        bench.start()
+        ready = bench.wait_ready()
+        measure = Measure(bench)
+        metrics = {}
+        warmed = streams.wait(lambda: streams.open_count('/station/0000') and streams.open_count('/station/0001'))
+        metrics['ready_to_warm_ms'] = ms(warmed and warmed - ready)
+
+        # two players on a warm neighbour share its single upstream and get
+        # its buffer right away
+        time.sleep(1)
+        neighbour = streams.url('station/0001')
+        first, player = relay_client(relay_port, neighbour)
+        second, other = relay_client(relay_port, neighbour)
+        metrics['warm_first_audio_ms'] = ms(max(first, second))
+        metrics['fanout_extra_upstreams'] = len(streams.connects_since('/station/0001', 0)) - 1
+        player.close()
+        other.close()
+
+        # away from 0 and 1: both are unwanted and without players now
+        switched = bench.firmware.encoder(5)
+        bench.mpd.wait_play(5, switched, 5)
+        expired = streams.wait(lambda: not streams.open_count('/station/0000') and not streams.open_count('/station/0001'), 10)
+        metrics['switch_to_expiry_ms'] = ms(expired and expired - switched)
+        metrics['unwanted_left_open'] = streams.open_count('/station/0000') + streams.open_count('/station/0001')
+
+        dropped = streams.drop('/station/0005')
+        back = streams.wait(lambda: streams.connects_since('/station/0005', dropped), 10)
+        metrics['drop_to_reconnect_ms'] = ms(back and back - dropped)
+        return measure.result(metrics)
+    finally:
+        streams.stop()
+
+
+SCENARIOS = [
+    ('idle', scenario_idle, {}),
+    ('startup', scenario_startup, {}),
+    ('encoder', scenario_encoder, {}),
+    ('spin', scenario_spin, {}),
+    ('churn', scenario_churn, {}),
+    ('drop', scenario_drop, {}),
+    ('stall', scenario_stall, {}),
+    ('volume', scenario_volume, {}),
+    ('big', scenario_big, {'stations': 5000}),
+    ('relay', scenario_relay, {'stations': 20}),
+]
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for scenario, metrics in sorted(results.items()):
+        for metric, value in sorted(metrics.items()):
+            old = baseline.get(scenario, {}).get(metric)
+            if value is None or old is None:
+                continue
+            # small absolute values are noise, counts of zero stay comparable
+            if value > old * (1 + tolerance) and value - old > 1:
+                regressions.append("%s %s: %s -> %s" % (scenario, metric, old, value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="run-radio.py benchmarks")
+    parser.add_argument("-s", "--scenario", action="append", choices=[name for name, run, options in SCENARIOS])
+    parser.add_argument("--stations", type=int, help="playlist size for the big scenario")
+    parser.add_argument("--protocol", type=int, default=2, choices=(1, 2))
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare against results saved with --json")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--keep", action="store_true", help="keep the temp directories with daemon logs")
+    args = parser.parse_args()
+
+    results = {}
+    for name, run, options in SCENARIOS:
+        if args.scenario and name not in args.scenario:
+            continue
+        stations = options.get('stations', 240)
+        if name == 'big' and args.stations:
+            stations = args.stations
+        bench = Bench(stations, args.protocol, args.keep)
+        try:
+            results[name] = run(bench)
+        except RuntimeError as e:
+            print "%s: %s" % (name, e)
+            results[name] = {}
+        finally:
+            bench.close()
+        for metric, value in sorted(results[name].items()):
+            print "%-10s %-32s %s" % (name, metric, value)
+
+    if args.json:
+        fdst = open(args.json, "w")
+        json.dump(results, fdst, indent=2, sort_keys=True)
+        fdst.close()
+
+    if args.baseline:
+        fsrc = open(args.baseline)
+        baseline = json.load(fsrc)
+        fsrc.close()
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print "regression: " + line
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
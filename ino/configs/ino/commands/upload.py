@@ -5,6 +5,9 @@ from __future__ import absolute_import
 import os.path
 import subprocess
 import platform
+import hashlib
+import json
+import time
 
 from time import sleep
 from serial import Serial
@@ -18,7 +21,9 @@ class Upload(Command):
     """
     Upload built firmware to the device.
 
-    The firmware must be already explicitly built with `ino build'. If current
+    The firmware must be already explicitly built with `ino build'. An image
+    identical to the one uploaded last time is skipped, unless --force is
+    given; --verify only reads the chip back and compares. If current
     device firmare reads/writes serial port extensively, upload may fail. In
     that case try to retry few times or upload just after pushing Reset button
     on Arduino board.
@@ -31,6 +36,10 @@ class Upload(Command):
         super(Upload, self).setup_arg_parser(parser)
         parser.add_argument('-p', '--serial-port', metavar='PORT',
                             help='Serial port to upload firmware to\nTry to guess if not specified')
+        parser.add_argument('-f', '--force', action='store_true',
+                            help='Upload even if the same firmware was uploaded last time')
+        parser.add_argument('--verify', action='store_true',
+                            help='Only compare the firmware on the chip with the built one')
 
         self.e.add_board_model_arg(parser)
         self.e.add_arduino_dist_arg(parser)
@@ -45,6 +54,7 @@ class Upload(Command):
             self.e.find_arduino_file('avrdude.conf', ['hardware', 'tools', 'avr', 'etc'])
     
     def run(self, args):
+        timer = PhaseTimer()
         self.discover()
         port = args.serial_port or self.e.guess_serial_port()
         board = self.e.board_model(args.board_model)
@@ -118,13 +128,40 @@ class Upload(Command):
 
             port = caterina_port
 
-        # call avrdude to upload .hex
+        # call avrdude to upload .hex, unless the chip already has this image
+        hex_path = os.path.join(os.getcwd(), self.e['hex_path'])
+        timer.phase('port')
+
+        image = {
+            'sha1': self.hex_digest(hex_path),
+            'mcu': board['build']['mcu'],
+            'port': port,
+        }
+        timer.phase('hash')
+
+        if args.verify:
+            # read the flash back and compare, nothing is written
+            if self.avrdude(board, port, protocol, 'flash:v:%s:i' % hex_path):
+                self.forget(hex_path)
+                timer.report()
+                raise Abort("Firmware on the chip differs from %s" % hex_path)
+            timer.phase('verify')
+            self.remember(hex_path, image)
+            print "Firmware on the chip matches %s (sha1 %s)" % (hex_path, image['sha1'][:12])
+        elif not args.force and self.unchanged(hex_path, image):
+            print "Firmware unchanged since the last upload (sha1 %s), skipping" % image['sha1'][:12]
+        else:
+            if self.avrdude(board, port, protocol, 'flash:w:%s:i' % hex_path):
+                self.forget(hex_path)
+                timer.report()
+                raise Abort("avrdude failed to upload %s" % hex_path)
+            timer.phase('write')
+            self.remember(hex_path, image)
 
-	print "hex_path:"
-	print os.getcwd() + '/' + self.e['hex_path']
+        timer.report()
 
-	hex_path = os.getcwd() + '/' + self.e['hex_path']
-	cmd_args = [
+    def avrdude(self, board, port, protocol, operation):
+        cmd_args = [
             'sudo', self.e['avrdude'],
             '-C', self.e['avrdude.conf'],
             '-p', board['build']['mcu'],
@@ -132,8 +169,59 @@ class Upload(Command):
             '-c', protocol,
             # '-b', board['upload']['speed'],
             # '-D',
-            '-U', 'flash:w:%s:i' % hex_path,
+            '-U', operation,
         ]
-	print cmd_args
-
-        subprocess.call(cmd_args)
+        print ' '.join(cmd_args)
+        return subprocess.call(cmd_args)
+
+    def hex_digest(self, hex_path):
+        digest = hashlib.sha1()
+        with open(hex_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def record_path(self, hex_path):
+        # next to the hex, so `ino clean' also forgets what was flashed
+        return os.path.join(os.path.dirname(hex_path), 'last-flash.json')
+
+    def recall(self, hex_path):
+        try:
+            with open(self.record_path(hex_path)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def unchanged(self, hex_path, image):
+        record = self.recall(hex_path) or {}
+        return all(record.get(key) == value for key, value in image.items())
+
+    def remember(self, hex_path, image):
+        image = dict(image, time=int(time.time()))
+        with open(self.record_path(hex_path), 'w') as f:
+            json.dump(image, f)
+
+    def forget(self, hex_path):
+        # a failed or partial write leaves the chip in an unknown state
+        try:
+            os.remove(self.record_path(hex_path))
+        except OSError:
+            pass
+
+
+class PhaseTimer(object):
+
+    def __init__(self):
+        self.started = time.time()
+        self.last = self.started
+        self.phases = []
+
+    def phase(self, name):
+        now = time.time()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def report(self):
+        parts = ['%s %d ms' % (name, duration * 1000) for name, duration in self.phases]
+        parts.append('total %d ms' % ((time.time() - self.started) * 1000))
+        print 'upload: ' + ', '.join(parts)
@@ -18,13 +18,15 @@
 
 #define NUM_READINGS 1 // number of analog reading to average it's value
 #define SERIAL_SPEED 9600 // serial port speed
-#define SERIAL_BUF_LEN 32 // serial reading buffer
+#define SERIAL_BUF_LEN 96 // serial reading buffer, fits a full U frame
+#define PROTOCOL_VERSION 2 // framed protocol version reported to the Pi
 
 #define EEPROM_ADDRESS_OFFSET 400 // address offset to start reading/wring to the EEPROM 
 
 #define DELAY_VOLUME 3000 // volume bar show decay  
 #define DELAY_ENCODER 100 // delay between sending encoder changes back to Pi 
 #define DELAY_ALARM 100 // delay between sending alarm changes back to Pi
+#define DELAY_VOLUME_SEND 100 // min delay between sending volume changes back to Pi
 #define DELAY_MODE 400 // mode switch debounce delay
 #define DELAY_EEPROM 10000 // delay to store to the EEPROM
 #define DELAY_BLINK 500 // bink delay
@@ -39,10 +41,13 @@ Encoder enc(2, 3); // encoder pins A and B connected to D2 and D3
 char buf[SERIAL_BUF_LEN+1]; // serial buffer
 byte index = 0; // current buffer position
 const char sep = ':';  // incoming command separator
+byte last_seq = 0; // sequence number of the last applied frame
+bool have_seq = false; // true once a frame has been applied
 
 bool buffering = true; // buffering mode, default to On
 bool need_enc = false; // need to send encoder value to the Pi backend, default to false
 bool need_vol = false; // need to send volume value to the Pi backend, default to false
+bool send_vol = false; // volume changed since it was last sent to the Pi
 bool init_done = false; // boot done (pyradio service has been started and sent initial data), default to false
 bool power_on = true; // power on state
 bool blink_on = true; // blink state
@@ -57,6 +62,7 @@ int max_vol = 100; // max volume value
 
 unsigned long current = 0; // current timestamp
 unsigned long last_vol = 0; // timestamp of last volume changed
+unsigned long last_vol_sent = 0; // timestamp of last volume sent to the Pi
 unsigned long last_enc = 0; // timestamp of last encoder changed
 unsigned long last_blink = 0; // timestamp of last blink state changed
 unsigned long last_alarm = 0; // timestamp of last alarm state changed
@@ -523,8 +529,16 @@ void loop() {
     prev_vol = vol;
     last_vol = current;
     need_vol = true;
+    send_vol = true;
     sendPT2314();
   }
+
+  // send volume while the knob turns, but not more often than DELAY_VOLUME_SEND
+  if (send_vol && init_done && current - last_vol_sent >= DELAY_VOLUME_SEND) {
+    sendVolume();
+    last_vol_sent = current;
+    send_vol = false;
+  }
   
   if (tones[0] != prev_tones[0] || tones[1] != prev_tones[1]) {
     last_tone = current;
@@ -610,7 +624,9 @@ void storeTones() {
  * Send tone control values to the PT2314
  */
 void sendPT2314() {
-  audio.volume(vol);
+  // once the Pi is up it owns the volume (V: -> mpd setvol), the chip stays
+  // at full scale so the knob does not attenuate twice
+  audio.volume(init_done && power_on ? max_vol : vol);
   audio.bass(tones[0]);
   audio.treble(tones[1]);
   audio.channel(0);
@@ -711,7 +727,12 @@ void setEncoder(int value) {
      while (Serial.available()) {
          char c = Serial.read();
          if (c == '\n' || c == '\r' || index >= SERIAL_BUF_LEN) {
-           buffering = false;
+           // stop at the line end, the next line stays in the UART buffer
+           // until the next loop, so back-to-back lines are never merged
+           if (index > 0) {
+             buffering = false;
+             break;
+           }
          } else {
            buffering = true;
            buf[index] = c;
@@ -728,26 +749,125 @@ void setEncoder(int value) {
   * @return void
   */
  void processInput() {
-  
-     char *cmd = strtok(buf, ":");
+     if (buf[0] == '#') {
+       processFrame();
+     } else {
+       processCommand(buf);
+     }
+ }
+
+ /**
+  * Parse two hex digits
+  */
+ int hexByte(const char *s) {
+   int value = 0;
+   for (byte i=0; i<2; i++) {
+     char c = s[i];
+     value <<= 4;
+     if (c >= '0' && c <= '9') {
+       value |= c - '0';
+     } else if (c >= 'A' && c <= 'F') {
+       value |= c - 'A' + 10;
+     } else {
+       return -1;
+     }
+   }
+   return value;
+ }
+
+ /**
+  * Framed command: #<seq><payload>*<checksum>, seq and checksum are two hex digits,
+  * checksum is XOR of all bytes between '#' and '*'. Every frame is acknowledged
+  * with K:<seq>, frames with bad checksum are rejected with N:<seq>.
+  * A repeated frame (lost ack) is acknowledged again, but not applied twice.
+  */
+ void processFrame() {
+   char *star = strrchr(buf, '*');
+   if (star == NULL || star - buf < 3) return;
+   int seq = hexByte(buf + 1);
+   if (seq < 0) return;
+   byte sum = 0;
+   for (char *p = buf + 1; p < star; p++) {
+     sum ^= *p;
+   }
+   if (hexByte(star + 1) != sum) {
+     sendAck('N', seq);
+     return;
+   }
+   *star = '\0';
+   if (!have_seq || seq != last_seq) {
+     processCommand(buf + 3);
+   }
+   last_seq = seq;
+   have_seq = true;
+   sendAck('K', seq);
+ }
+
+ /**
+  * Copy text into the LCD buffer, trimmed to the display width
+  */
+ void copyText(char *dst, const char *src) {
+   if (src == NULL) {
+     dst[0] = '\0';
+     return;
+   }
+   strncpy(dst, src, COLS);
+   dst[COLS] = '\0';
+ }
+
+ /**
+  * Batched screen update: U:<title>|<song1>|<song2>|<HH:MM>
+  */
+ void processUpdate(char *line) {
+   char *fields[4];
+   byte n = 0;
+   fields[n++] = line;
+   for (char *p = line; *p != '\0' && n < 4; p++) {
+     if (*p == '|') {
+       *p = '\0';
+       fields[n++] = p + 1;
+     }
+   }
+   if (n < 4) return;
+   copyText(title, fields[0]);
+   copyText(song1, fields[1]);
+   copyText(song2, fields[2]);
+   time_hours = atoi(fields[3]);
+   char *colon = strchr(fields[3], ':');
+   if (colon != NULL) {
+     time_minutes = atoi(colon + 1);
+   }
+ }
+
+ /**
+  * Apply a single command line
+  */
+ void processCommand(char *line) {
+
+     if (strncmp(line, "U:", 2) == 0) {
+       processUpdate(line + 2);
+       return;
+     }
+
+     char *cmd = strtok(line, ":");
      char *arg1 = strtok(NULL, ":");
      char *arg2 = strtok(NULL, ":");
      char *arg3 = strtok(NULL, ":");
-     if (strlen(buf) == 0 || cmd == NULL) return;  
+     if (strlen(line) == 0 || cmd == NULL) return;  
 
      // station title
      if (strcmp(cmd,"S0") == 0) {
-         strcpy(title, arg1);
+         copyText(title, arg1);
      } 
 
      // current playing song row 1
      if (strcmp(cmd, "S1") == 0) {
-         strcpy(song1, arg1);
+         copyText(song1, arg1);
      }
      
      // current playing song row 2
      if (strcmp(cmd, "S2") == 0) {
-         strcpy(song2, arg1);
+         copyText(song2, arg1);
      }
 
      // current time HH:MM
@@ -760,7 +880,7 @@ void setEncoder(int value) {
      if (strcmp(cmd, "AL") == 0) {
        alarm_hours = atoi(arg1);
        alarm_minutes = atoi(arg2);
-       alarm_on = (strcmp(arg3, "1") == 0) ? true : false;
+       alarm_on = (arg3 != NULL && strcmp(arg3, "1") == 0) ? true : false;
      }
           
      // done init <encoder value>:<max value>
@@ -769,10 +889,35 @@ void setEncoder(int value) {
        max_stations = atoi(arg2);
        printStation(station);
        init_done = true;
+       sendPT2314(); // hand the volume over to the Pi
        mode_changed = true;
        need_vol = true;
+       send_vol = true; // the Pi learns the knob position
        prev_vol = -1; // force show volume
      }
+
+     // station chosen on the host side, the encoder follows it without
+     // sending it back
+     if (strcmp(cmd, "ST") == 0) {
+       station = atoi(arg1);
+       prev_station = station;
+       setEncoder(station);
+     }
+
+     // power on from the host (alarm), the radio may have been switched off
+     // with the power button
+     if (strcmp(cmd, "PW") == 0) {
+       if (!power_on) {
+         powerOn();
+       }
+     }
+
+     // protocol version query, answer with the highest supported version
+     if (strcmp(cmd, "PV") == 0) {
+       have_seq = false;
+       Serial.print("PV:");
+       Serial.println(PROTOCOL_VERSION);
+     }
  }
  
 void sendStation() {
@@ -780,6 +925,20 @@ void sendStation() {
   Serial.println(station);
 }
 
+void sendVolume() {
+  Serial.print("V:");
+  Serial.println(vol);
+}
+
+void sendAck(char code, byte seq) {
+  Serial.print(code);
+  Serial.print(":");
+  if (seq < 16) {
+    Serial.print("0");
+  }
+  Serial.println(seq, HEX);
+}
+
 void sendAlarm() {
   Serial.print("A:");
   Serial.print(alarm_hours);
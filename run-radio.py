@@ -1,19 +1,109 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import re
+import os
+import sys
+import signal
+import errno
+import heapq
+import marshal
+import struct
 import codecs
 import time
+import select
+import threading
 import serial
 import textwrap
+import unicodedata
+import collections
+import ctypes
+import ctypes.util
+import json
+import glob
+import fnmatch
+import bisect
+import logging
+import logging.handlers
+import urlparse
+import socket
+import urllib
+import urllib2
+import BaseHTTPServer
+import SocketServer
+from multiprocessing.pool import ThreadPool
 from mpd import MPDClient, MPDError, CommandError
 from time import gmtime, strftime
-from datetime import datetime
+from datetime import datetime, timedelta
+
+
+log = logging.getLogger("radio")
+
+
+class LogLimiter:
+
+    # at most Config.log_burst messages per call site in Config.log_window,
+    # a port or a server that keeps failing must not flood the log
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sites = {}
+        self.suppressed = 0
+
+    def allow(self, site, now):
+        # returns (log this one, messages suppressed in the previous window)
+        with self.lock:
+            window = self.sites.get(site)
+            if window is None or now - window[0] >= Config.log_window:
+                self.sites[site] = [now, 1, 0]
+                return True, window[2] if window else 0
+            window[1] += 1
+            if window[1] <= Config.log_burst:
+                return True, 0
+            window[2] += 1
+            self.suppressed += 1
+            return False, 0
+
+
+limiter = LogLimiter()
+
+
+def emit(level, message):
+    if not log.isEnabledFor(level):
+        return
+    caller = sys._getframe(2)
+    allowed, suppressed = limiter.allow((caller.f_code, caller.f_lineno), monotonic())
+    if suppressed:
+        log.log(level, "%d similar messages suppressed" % suppressed)
+    if allowed:
+        log.log(level, message)
 
 
 def debug(message):
-    if Config.debug:
-        print message
+    emit(logging.DEBUG, message)
+
+
+def info(message):
+    emit(logging.INFO, message)
+
+
+def warning(message):
+    emit(logging.WARNING, message)
+
+
+def setup_logging():
+    # run-radio.sh throws stdout away, so the daemon keeps its own rotated log
+    if Config.log_file:
+        logdir = os.path.dirname(Config.log_file)
+        if logdir and not os.path.isdir(logdir):
+            os.makedirs(logdir)
+        handler = logging.handlers.RotatingFileHandler(Config.log_file, maxBytes=Config.log_size, backupCount=Config.log_count)
+    else:
+        handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    logging.root.addHandler(handler)
+    logging.root.setLevel(Config.log_level)
+    # python-mpd2 logs every connect at info
+    logging.getLogger("mpd").setLevel(max(logging.WARNING, log.getEffectiveLevel()))
 
 
 class Config:
@@ -21,23 +111,1412 @@ class Config:
     COLS = 21
     ROWS = 3
 
-    debug = True
+    log_level = "INFO"
+    log_file = "/home/pi/PiRadio/logs/radio.log"
+    log_size = 1024 * 1024
+    log_count = 3
+    log_burst = 10
+    log_window = 60
+
+    metrics_port = 9105
+
+    trace = None
+    trace_buffer = 64 * 1024
+    trace_result = 256
+    trace_flush = 10
+    trace_size = 8 * 1024 * 1024
+
+    control_port = 8766
+    control_socket = None
+    control_buffer = 64 * 1024
+    profile_interval = 0.005
+    profile_max = 60
 
     serial_dev = ["/dev/ttyAMA0"]
     serial_speed = 9600
 
     playlist = "/home/pi/PiRadio/data/radio.m3u"
+    playlist_cache = "/home/pi/PiRadio/data/radio.m3u.cache"
+    playlist_poll = 5
+    reload_delay = 1.0
     state = "/home/pi/PiRadio/data/state.txt"
     alarm = "/home/pi/PiRadio/data/alarm.txt"
-    save_timeout = 500
+    switch_delay = 0.08
+    switch_settle = 0.6
+    spin_gap = 0.25
+    volume_hysteresis = 2
+    volume_interval = 0.1
+    state_window = 10
+    history = "/home/pi/PiRadio/data/history.log"
+    history_size = 500
+    history_bytes = 256 * 1024
+    history_keep = 3
+    history_sync = 30
+
+    alarm_prebuffer = 20
+    alarm_grace = 300
+    alarm_ramp = 30
+    alarm_volume = 40
+
+    relay = False
+    relay_port = 8765
+    relay_neighbours = 1
+    relay_buffer = 256 * 1024
+    relay_memory = 2 * 1024 * 1024
+    relay_metaint = 8192
+    relay_idle = 60
+
+    probe = True
+    probe_index = "/home/pi/PiRadio/data/probe.json"
+    probe_interval = 6 * 3600
+    probe_workers = 4
+    probe_rate = 2
+    probe_timeout = 5
+    probe_skip_dead = False
+
+    watchdog = True
+    mirrors = "/home/pi/PiRadio/data/mirrors.json"
+    watchdog_interval = 1.0
+    stall_timeout = 4
+    stall_connect = 10
+    watchdog_proven = 60
+    watchdog_backoff_min = 5
+    watchdog_backoff_max = 300
 
     mpd_host = "localhost"
     mpd_port = 6600
     mpd_password = "admin"
+    mpd_timeout = 2
+    mpd_backoff_min = 0.05
+    mpd_backoff_max = 30
+    mpd_queue = 8
 
     init_delay = 0.1
-    write_delay = 0.35
-    read_delay = 0.1
+    serial_rate = 300
+    serial_burst = 64
+
+    protocol = 2
+    ack_timeout = 0.25
+    ack_retries = 3
+    poll_delay = 0.5
+    idle_retry = 30
+    read_timeout = 0.5
+    protocol_retry = 60
+    serial_retry = 1.0
+    serial_retry_max = 30
+    serial_settle = 0.5
+    stats_interval = 60
+    layout_cache = 32
+    translit_cache = 256
+    marquee_delay = 3.0
+    startup_budget = 2.0
+
+
+class Histogram:
+
+    def __init__(self, name, help, buckets, label=None):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.label = label
+        self.lock = threading.Lock()
+        # label value -> [count per bucket, sum, count]
+        self.series = {}
+
+    def observe(self, value, label_value=None):
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = [[0] * len(self.buckets), 0.0, 0]
+            idx = bisect.bisect_left(self.buckets, value)
+            if idx < len(self.buckets):
+                series[0][idx] += 1
+            series[1] += value
+            series[2] += 1
+
+    def join(self, labels, bucket):
+        return labels + ',' + bucket if labels else bucket
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        with self.lock:
+            for label_value, (counts, total, count) in sorted(self.series.items()):
+                labels = ''
+                if self.label is not None:
+                    labels = '%s="%s"' % (self.label, label_value)
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    lines.append('%s_bucket{%s} %d' % (self.name, self.join(labels, 'le="%g"' % bound), cumulative))
+                lines.append('%s_bucket{%s} %d' % (self.name, self.join(labels, 'le="+Inf"'), count))
+                suffix = '{%s}' % labels if labels else ''
+                lines.append('%s_sum%s %f' % (self.name, suffix, total))
+                lines.append('%s_count%s %d' % (self.name, suffix, count))
+        return lines
+
+
+class Sampled:
+
+    # counter or gauge read from the object that keeps it at scrape time
+
+    def __init__(self, name, help, kind, getter):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.getter = getter
+
+    def render(self):
+        return ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.kind), "%s %s" % (self.name, self.getter())]
+
+
+class Metrics:
+
+    seconds = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+    def __init__(self):
+        self.items = collections.OrderedDict()
+        self.loop_time = self.histogram("radio_loop_iteration_seconds", "Main loop work per wakeup", self.seconds)
+        self.mpd_time = self.histogram("radio_mpd_command_seconds", "MPD command round trip", self.seconds, "command")
+        self.serial_time = self.histogram("radio_serial_write_seconds", "Serial write including the ack", self.seconds)
+        self.serial_depth = self.histogram("radio_serial_queue_depth", "Pending serial writes", (0, 1, 2, 4, 8, 16, 32))
+        self.encoder_time = self.histogram("radio_encoder_to_audio_seconds", "Last encoder move to the play command", (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10))
+        self.counter("radio_log_suppressed_total", "Log messages dropped by the rate limit", lambda: limiter.suppressed)
+
+    def histogram(self, name, help, buckets, label=None):
+        self.items[name] = Histogram(name, help, buckets, label)
+        return self.items[name]
+
+    def counter(self, name, help, getter):
+        self.items[name] = Sampled(name, help, "counter", getter)
+
+    def gauge(self, name, help, getter):
+        self.items[name] = Sampled(name, help, "gauge", getter)
+
+    def render(self):
+        lines = []
+        for item in self.items.values():
+            lines.extend(item.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class Timespec(ctypes.Structure):
+
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+class MonotonicClock:
+
+    # seconds that never step with the wall clock (ntp after boot, a manual
+    # date), for timers and intervals; python 2 has no time.monotonic
+
+    CLOCK_MONOTONIC = 1
+
+    def __init__(self):
+        try:
+            self.clock_gettime = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            self.clock_gettime = None
+
+    def __call__(self):
+        timespec = Timespec()
+        if self.clock_gettime is not None and self.clock_gettime(self.CLOCK_MONOTONIC, ctypes.byref(timespec)) == 0:
+            return timespec.tv_sec + timespec.tv_nsec * 1e-9
+        return time.time()
+
+
+monotonic = MonotonicClock()
+
+
+class Tracer:
+
+    # Config.trace: one json line per serial line in and out, mpd command,
+    # idle change and title change, stamped with CLOCK_MONOTONIC seconds
+    # since the start line. bench/replay.py plays the serial input and the
+    # titles of a trace back, with the recorded mpd round trips. Past
+    # Config.trace_size the file moves to .1 and a new one starts with the
+    # start and playlist lines again, so either file replays on its own
+
+    def __init__(self):
+        self.fdst = None
+        self.lock = threading.Lock()
+        self.started = 0
+        self.filename = None
+        self.header = None
+        self.playlist = None
+
+    def open(self, filename, **header):
+        try:
+            self.fdst = open(filename, "a", Config.trace_buffer)
+        except IOError as e:
+            warning("Unable to open trace: " + str(e))
+            return
+        self.filename = filename
+        self.started = monotonic()
+        header['wall'] = time.time()
+        self.header = header
+        self.record('start', header)
+        info("tracing to " + filename)
+
+    def line(self, kind, data):
+        return json.dumps({'t': round(monotonic() - self.started, 6), 'k': kind, 'd': data}, separators=(',', ':'), default=repr) + "\n"
+
+    def record(self, kind, data):
+        if self.fdst is None:
+            return
+        line = self.line(kind, data)
+        with self.lock:
+            if kind == 'playlist':
+                self.playlist = data
+            self.fdst.write(line)
+            if self.fdst.tell() >= Config.trace_size:
+                self.rotate()
+
+    def rotate(self):
+        # with the lock held
+        self.fdst.close()
+        try:
+            os.rename(self.filename, self.filename + ".1")
+            self.fdst = open(self.filename, "a", Config.trace_buffer)
+        except (IOError, OSError) as e:
+            self.fdst = None
+            warning("Unable to rotate trace: " + str(e))
+            return
+        self.fdst.write(self.line('start', dict(self.header, rotated=True)))
+        if self.playlist is not None:
+            self.fdst.write(self.line('playlist', self.playlist))
+
+    def result(self, value):
+        # small mpd results in full, big ones (playlistinfo) by size only
+        text = json.dumps(value, default=repr)
+        if len(text) > Config.trace_result:
+            return {'size': len(value) if hasattr(value, '__len__') else len(text)}
+        return value
+
+    def flush(self):
+        if self.fdst is not None:
+            with self.lock:
+                self.fdst.flush()
+
+
+trace = Tracer()
+
+
+class EventLoop:
+
+    def __init__(self):
+        self.readers = {}
+        self.writers = {}
+        self.timers = []
+        self.seq = 0
+        self.wakeups = 0
+        self.last_wakeups = 0
+        self.last_stats = monotonic()
+        self.pending = collections.deque()
+        self.thread_id = None
+        self.pipe_r, self.pipe_w = os.pipe()
+        self.add_reader(self.pipe_r, self.run_pending)
+
+    def add_reader(self, fd, callback):
+        self.readers[fd] = callback
+
+    def remove_reader(self, fd):
+        self.readers.pop(fd, None)
+
+    def add_writer(self, fd, callback):
+        self.writers[fd] = callback
+
+    def remove_writer(self, fd):
+        self.writers.pop(fd, None)
+
+    def call_at(self, deadline, callback):
+        # deadline in wall clock time, the timer itself runs on the monotonic
+        # clock: a later clock step does not stretch or skip it
+        return self.call_later(deadline - time.time(), callback)
+
+    def call_later(self, delay, callback):
+        self.seq += 1
+        timer = [monotonic() + delay, self.seq, callback, False]
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def cancel(self, timer):
+        if timer is not None:
+            timer[3] = True
+
+    def call_soon_threadsafe(self, callback):
+        # may be called from any thread, wakes the loop through the pipe
+        self.pending.append(callback)
+        os.write(self.pipe_w, "x")
+
+    def run_pending(self):
+        os.read(self.pipe_r, 512)
+        while self.pending:
+            self.pending.popleft()()
+
+    def drop_bad_readers(self):
+        for fd in self.readers.keys() + self.writers.keys():
+            try:
+                os.fstat(fd)
+            except OSError:
+                self.remove_reader(fd)
+                self.remove_writer(fd)
+
+    def wakeups_per_minute(self):
+        now = monotonic()
+        elapsed = now - self.last_stats
+        count = self.wakeups - self.last_wakeups
+        self.last_stats = now
+        self.last_wakeups = self.wakeups
+        if elapsed <= 0:
+            return 0
+        return int(round(count * 60.0 / elapsed))
+
+    def next_timeout(self):
+        while self.timers and self.timers[0][3]:
+            heapq.heappop(self.timers)
+        if not self.timers:
+            return None
+        return max(0, self.timers[0][0] - monotonic())
+
+    def run_once(self):
+        timeout = self.next_timeout()
+        try:
+            readable, writable, _ = select.select(self.readers.keys(), self.writers.keys(), [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            if e.args[0] == errno.EBADF:
+                self.drop_bad_readers()
+                return
+            raise
+        self.wakeups += 1
+        started = monotonic()
+        for fd in readable:
+            callback = self.readers.get(fd)
+            if callback is not None:
+                callback()
+        for fd in writable:
+            callback = self.writers.get(fd)
+            if callback is not None:
+                callback()
+        now = monotonic()
+        while self.timers and (self.timers[0][3] or self.timers[0][0] <= now):
+            timer = heapq.heappop(self.timers)
+            if not timer[3]:
+                timer[3] = True
+                timer[2]()
+        metrics.loop_time.observe(monotonic() - started)
+
+    def run(self):
+        self.thread_id = threading.current_thread().ident
+        while True:
+            self.run_once()
+
+
+class SerialWriter:
+
+    # commands for which only the latest pending value matters
+    coalesced = ('S0', 'S1', 'S2', 'TM', 'AL', 'D', 'ST')
+
+    # commands batched into a single U frame in protocol 2
+    screen = ('S0', 'S1', 'S2', 'TM')
+
+    def __init__(self, interface):
+        self.interface = interface
+        self.pending = collections.OrderedDict()
+        self.cond = threading.Condition()
+        self.seq = 0
+        self.tokens = Config.serial_burst
+        self.last_fill = monotonic()
+        self.on_error = None
+        self.display = dict((slot, '') for slot in self.screen)
+        self.frame_seq = 0
+        self.retries = 0
+        self.acked = threading.Event()
+        self.ack_seq = None
+        self.fallback = None
+        self.thread = threading.Thread(target=self.run, name="serial-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, data):
+        slot = data.split(':', 1)[0]
+        with self.cond:
+            if slot in self.screen:
+                self.display[slot] = data[len(slot) + 1:]
+            if slot in self.coalesced:
+                self.pending.pop(slot, None)
+            else:
+                self.seq += 1
+                slot = self.seq
+            self.pending[slot] = data
+            metrics.serial_depth.observe(len(self.pending))
+            self.cond.notify()
+
+    def clear(self):
+        with self.cond:
+            self.pending.clear()
+
+    def depth(self):
+        return len(self.pending)
+
+    def take_tokens(self, cost):
+        # byte rate token bucket sized to the AVR receive buffer; the bucket
+        # never holds more than the burst, a bigger cost would wait forever
+        cost = min(cost, Config.serial_burst)
+        while True:
+            now = monotonic()
+            self.tokens = min(Config.serial_burst, self.tokens + (now - self.last_fill) * Config.serial_rate)
+            self.last_fill = now
+            if self.tokens >= cost:
+                self.tokens -= cost
+                return
+            time.sleep((cost - self.tokens) / float(Config.serial_rate))
+
+    def take_frame(self):
+        # in queue order: a run of screen slots at the head goes out as one U
+        # frame, screen slots queued behind a D: (which clears the song rows
+        # on the firmware) wait for a U frame of their own after it
+        slot = next(iter(self.pending))
+        if slot not in self.screen:
+            slot, data = self.pending.popitem(last=False)
+            return data
+        while self.pending and next(iter(self.pending)) in self.screen:
+            self.pending.popitem(last=False)
+        rows = [self.display[slot].replace('|', '/') for slot in self.screen]
+        return 'U:' + '|'.join(rows)
+
+    def requeue(self, payload):
+        # a payload the firmware never acked goes back to the head of the
+        # queue under its own slot, unless a newer value already waits there
+        if payload.startswith('U:'):
+            entries = [(slot, slot + ':' + self.display[slot]) for slot in self.screen]
+        else:
+            entries = [(payload.split(':', 1)[0], payload)]
+        with self.cond:
+            head = []
+            for slot, data in entries:
+                if slot not in self.coalesced:
+                    self.seq += 1
+                    slot = self.seq
+                elif slot in self.pending:
+                    continue
+                head.append((slot, data))
+            queued = head + self.pending.items()
+            self.pending.clear()
+            self.pending.update(queued)
+            self.cond.notify()
+
+    def write_line(self, data):
+        # in pieces no larger than the burst, paced by the token bucket, so a
+        # full U frame never overruns the 64 byte receive buffer of the AVR
+        line = data + "\r\n"
+        for start in range(0, len(line), Config.serial_burst):
+            piece = line[start:start + Config.serial_burst]
+            self.take_tokens(len(piece))
+            if not self.interface.write(piece):
+                return False
+        debug("write: " + data)
+        trace.record('tx', data)
+        return True
+
+    def ack(self, seq, ok):
+        self.ack_seq = (seq, ok)
+        self.acked.set()
+
+    def send_frame(self, payload):
+        self.frame_seq = (self.frame_seq + 1) & 0xff
+        body = "%02X%s" % (self.frame_seq, payload)
+        checksum = 0
+        for c in body:
+            checksum ^= ord(c)
+        frame = "#%s*%02X" % (body, checksum)
+        for attempt in range(Config.ack_retries):
+            self.acked.clear()
+            self.ack_seq = None
+            if not self.write_line(frame):
+                return False
+            if self.acked.wait(Config.ack_timeout) and self.ack_seq == (self.frame_seq, True):
+                return True
+            self.retries += 1
+            warning("no ack for frame %02X, retrying" % self.frame_seq)
+        # firmware stopped answering, go back to the line protocol and ask
+        # for frames again after Config.protocol_retry
+        warning("falling back to protocol 1")
+        self.interface.protocol = 1
+        self.fallback = monotonic()
+        self.requeue(payload)
+        return True
+
+    def retry_protocol(self):
+        if self.fallback is None or self.interface.protocol >= 2:
+            self.fallback = None
+            return
+        if monotonic() - self.fallback >= Config.protocol_retry:
+            # a PV:2 answer switches the interface back to frames
+            self.fallback = monotonic()
+            self.write_line('PV:' + str(Config.protocol))
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+            self.retry_protocol()
+            with self.cond:
+                if not self.pending:
+                    continue
+                if self.interface.protocol >= 2:
+                    data = self.take_frame()
+                else:
+                    slot, data = self.pending.popitem(last=False)
+            started = time.time()
+            if self.interface.protocol >= 2:
+                ok = data == '' or self.send_frame(data)
+            else:
+                ok = self.write_line(data)
+            metrics.serial_time.observe(time.time() - started)
+            if not ok:
+                self.clear()
+                if self.on_error is not None:
+                    self.on_error()
+
+
+class Inotify:
+
+    IN_ATTRIB = 0x04
+    IN_CLOSE_WRITE = 0x08
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+
+    def __init__(self):
+        # raises OSError (or AttributeError without libc support) when
+        # inotify is unavailable
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+
+    def add_watch(self, directory, mask):
+        wd = self.libc.inotify_add_watch(self.fd, directory, mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed: " + directory)
+        return wd
+
+    def close(self):
+        os.close(self.fd)
+
+    def read(self):
+        # [(watch descriptor, event mask, file name)]
+        data = os.read(self.fd, 4096)
+        events = []
+        offset = 0
+        while offset + 16 <= len(data):
+            wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+            events.append((wd, mask, data[offset + 16:offset + 16 + length].rstrip("\0")))
+            offset += 16 + length
+        return events
+
+
+class PlaylistWatcher:
+
+    def __init__(self, loop, filename, callback):
+        self.loop = loop
+        self.filename = filename
+        self.callback = callback
+        self.reload_timer = None
+        self.stamp = self.current_stamp()
+        self.inotify = self.open_inotify()
+        if self.inotify is not None:
+            self.loop.add_reader(self.inotify.fd, self.on_inotify)
+        else:
+            self.loop.call_later(Config.playlist_poll, self.poll)
+
+    def open_inotify(self):
+        # watch the directory, editors usually replace the file with a rename
+        try:
+            inotify = Inotify()
+        except (OSError, AttributeError) as e:
+            info("inotify unavailable, polling playlist: " + str(e))
+            return None
+        try:
+            directory = os.path.dirname(os.path.abspath(self.filename))
+            inotify.add_watch(directory, Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO | Inotify.IN_CREATE)
+            return inotify
+        except OSError as e:
+            info("inotify unavailable, polling playlist: " + str(e))
+            inotify.close()
+            return None
+
+    def on_inotify(self):
+        name = os.path.basename(self.filename)
+        for wd, mask, event_name in self.inotify.read():
+            if event_name == name:
+                self.changed()
+
+    def poll(self):
+        self.changed()
+        self.loop.call_later(Config.playlist_poll, self.poll)
+
+    def current_stamp(self):
+        try:
+            st = os.stat(self.filename)
+            return (st.st_mtime, st.st_size)
+        except OSError:
+            return None
+
+    def changed(self):
+        stamp = self.current_stamp()
+        if stamp is None or stamp == self.stamp:
+            return
+        self.stamp = stamp
+        # editors write in several steps, wait for the file to settle
+        self.loop.cancel(self.reload_timer)
+        self.reload_timer = self.loop.call_later(Config.reload_delay, self.reload)
+
+    def reload(self):
+        self.reload_timer = None
+        thread = threading.Thread(target=self.parse, name="playlist-reload")
+        thread.daemon = True
+        thread.start()
+
+    def parse(self):
+        playlist = Playlist()
+        playlist.load(self.filename)
+        if playlist.list:
+            self.loop.call_soon_threadsafe(lambda: self.callback(playlist))
+
+
+class DeviceWatcher:
+
+    # wakes the serial retry when a node matching one of the serial_dev
+    # patterns shows up. A directory that does not exist yet (by-id only
+    # appears with the first usb serial device) is watched through its
+    # nearest existing parent
+
+    def __init__(self, loop, patterns, callback):
+        self.loop = loop
+        self.patterns = patterns
+        self.callback = callback
+        self.names = {}
+        self.inotify = None
+        try:
+            self.inotify = Inotify()
+            self.add_watches()
+            self.loop.add_reader(self.inotify.fd, self.on_inotify)
+        except (OSError, AttributeError) as e:
+            info("inotify unavailable, serial retried on a timer: " + str(e))
+            if self.inotify is not None:
+                self.inotify.close()
+                self.inotify = None
+
+    def add_watches(self):
+        for pattern in self.patterns:
+            directory, name = os.path.split(os.path.abspath(pattern))
+            while not os.path.isdir(directory):
+                directory, name = os.path.split(directory)
+            wd = self.inotify.add_watch(directory, Inotify.IN_CREATE | Inotify.IN_ATTRIB | Inotify.IN_MOVED_TO)
+            self.names.setdefault(wd, set()).add(name)
+
+    def on_inotify(self):
+        found = False
+        for wd, mask, name in self.inotify.read():
+            if any(fnmatch.fnmatch(name, pattern) for pattern in self.names.get(wd, ())):
+                found = True
+        if found:
+            try:
+                self.add_watches()
+            except OSError as e:
+                warning(str(e))
+            self.callback()
+
+
+class RelayUpstream:
+
+    def __init__(self, url):
+        self.url = url
+        self.cond = threading.Condition()
+        self.chunks = collections.deque()
+        self.size = 0
+        self.start = 0
+        self.end = 0
+        self.title = None
+        self.content_type = "audio/mpeg"
+        self.clients = 0
+        self.last_used = monotonic()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="relay-upstream")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+
+    def run(self):
+        delay = 1
+        while self.running:
+            try:
+                self.fetch()
+                delay = 1
+            except Exception as e:
+                warning("relay: %s: %s" % (self.url, e))
+            if self.running:
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    def fetch(self):
+        request = urllib2.Request(self.url, headers={'Icy-MetaData': '1', 'User-Agent': 'PiRadio'})
+        response = urllib2.urlopen(request, timeout=10)
+        try:
+            self.content_type = response.info().getheader('Content-Type') or self.content_type
+            metaint = int(response.info().getheader('icy-metaint') or 0)
+            while self.running:
+                if metaint:
+                    data = self.read(response, metaint)
+                    self.append(data)
+                    length = ord(self.read(response, 1)) * 16
+                    if length:
+                        self.parse_meta(self.read(response, length))
+                else:
+                    data = response.read(4096)
+                    if not data:
+                        raise IOError("stream ended")
+                    self.append(data)
+        finally:
+            response.close()
+
+    def read(self, response, size):
+        data = ""
+        while len(data) < size:
+            chunk = response.read(size - len(data))
+            if not chunk:
+                raise IOError("stream ended")
+            data += chunk
+        return data
+
+    def parse_meta(self, meta):
+        start = meta.find("StreamTitle='")
+        if start != -1:
+            end = meta.find("';", start)
+            self.title = meta[start + 13:end if end != -1 else None]
+
+    def append(self, data):
+        # rolling buffer, the oldest audio is dropped past relay_buffer bytes
+        with self.cond:
+            self.chunks.append(data)
+            self.size += len(data)
+            self.end += len(data)
+            while self.size - len(self.chunks[0]) >= Config.relay_buffer:
+                dropped = self.chunks.popleft()
+                self.size -= len(dropped)
+                self.start += len(dropped)
+            self.cond.notify_all()
+
+    def read_from(self, position, timeout=5):
+        # audio from byte position on, blocks until there is some
+        with self.cond:
+            while self.running and position >= self.end:
+                self.cond.wait(timeout)
+                if position >= self.end:
+                    return position, ""
+            position = max(position, self.start)
+            offset = self.start
+            parts = []
+            for chunk in self.chunks:
+                if offset + len(chunk) > position:
+                    parts.append(chunk[max(0, position - offset):])
+                offset += len(chunk)
+            data = "".join(parts)
+            return position + len(data), data
+
+
+class RelayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        relay = self.server.relay
+        url = urllib.unquote(self.path.lstrip('/'))
+        upstream = relay.acquire(url)
+        if upstream is None:
+            self.send_error(404)
+            return
+        try:
+            metaint = 0
+            if self.headers.getheader('Icy-MetaData') == '1':
+                metaint = Config.relay_metaint
+            self.send_response(200)
+            self.send_header('Content-Type', upstream.content_type)
+            if metaint:
+                self.send_header('icy-metaint', str(metaint))
+            self.end_headers()
+            self.stream(upstream, metaint)
+        except socket.error:
+            pass
+        finally:
+            relay.release(upstream)
+
+    def stream(self, upstream, metaint):
+        # start with everything buffered so the player fills its buffer at once
+        position = upstream.start
+        left = metaint
+        title = None
+        while upstream.running:
+            position, data = upstream.read_from(position)
+            if not metaint:
+                self.wfile.write(data)
+                continue
+            while data:
+                part = data[:left]
+                self.wfile.write(part)
+                data = data[len(part):]
+                left -= len(part)
+                if left == 0:
+                    # icy metadata block, the title is only repeated when it changes
+                    meta = ""
+                    if upstream.title is not None and upstream.title != title:
+                        title = upstream.title
+                        meta = "StreamTitle='%s';" % title.replace("'", "")
+                        meta += "\0" * (-len(meta) % 16)
+                    self.wfile.write(chr(len(meta) / 16) + meta)
+                    left = metaint
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RelayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class StreamRelay:
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.lock = threading.Lock()
+        self.upstreams = collections.OrderedDict()
+        self.allowed = set()
+        self.wanted = set()
+        self.server = RelayServer(('127.0.0.1', Config.relay_port), RelayHandler)
+        self.server.relay = self
+        thread = threading.Thread(target=self.server.serve_forever, name="relay")
+        thread.daemon = True
+        thread.start()
+        self.loop.call_later(Config.relay_idle, self.expire)
+
+    def url_for(self, url):
+        return "http://127.0.0.1:%d/%s" % (Config.relay_port, urllib.quote(url, safe=''))
+
+    def allow(self, urls):
+        # only playlist urls are relayed
+        with self.lock:
+            self.allowed = set(urls)
+
+    def warm(self, urls):
+        # keep these upstreams connected, the rest may be evicted
+        with self.lock:
+            self.wanted = set(urls)
+            for url in urls:
+                self.open(url)
+            self.evict()
+
+    def open(self, url):
+        upstream = self.upstreams.pop(url, None)
+        if upstream is None:
+            upstream = RelayUpstream(url)
+        upstream.last_used = monotonic()
+        self.upstreams[url] = upstream
+        return upstream
+
+    def evict(self):
+        # least recently used first, never one that is wanted or being played;
+        # past the memory limit, or once unused for relay_idle seconds
+        limit = max(1, Config.relay_memory / Config.relay_buffer)
+        idle = monotonic() - Config.relay_idle
+        for url in list(self.upstreams.keys()):
+            upstream = self.upstreams[url]
+            if url in self.wanted or upstream.clients > 0:
+                continue
+            if len(self.upstreams) > limit or upstream.last_used <= idle:
+                del self.upstreams[url]
+                upstream.stop()
+
+    def expire(self):
+        # an upstream nobody wants keeps downloading until it is evicted
+        with self.lock:
+            self.evict()
+        self.loop.call_later(Config.relay_idle, self.expire)
+
+    def acquire(self, url):
+        with self.lock:
+            if url not in self.allowed:
+                return None
+            upstream = self.open(url)
+            upstream.clients += 1
+            self.evict()
+            return upstream
+
+    def release(self, upstream):
+        with self.lock:
+            upstream.clients -= 1
+            upstream.last_used = monotonic()
+            self.evict()
+
+
+class StationProber:
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.store = JsonIndex(Config.probe_index, "probe index", loop)
+        self.index = self.store.data
+        self.urls = []
+        self.running = False
+        self.timer = None
+        self.on_update = None
+        self.lock = threading.Lock()
+        self.next_slot = 0
+
+    def set_stations(self, items):
+        # probe now if the index is missing entries or stale, then on schedule
+        self.urls = [url for item in items for url in (item.url,) + item.alternates]
+        now = time.time()
+        stale = [url for url in self.urls if now - self.index.get(url, {}).get('checked', 0) >= Config.probe_interval]
+        if stale:
+            self.start(stale)
+        else:
+            oldest = min([self.index[url]['checked'] for url in self.urls] or [now])
+            self.schedule(oldest + Config.probe_interval)
+
+    def schedule(self, deadline):
+        self.loop.cancel(self.timer)
+        self.timer = self.loop.call_at(deadline, self.refresh)
+
+    def refresh(self):
+        self.timer = None
+        self.start(self.urls)
+
+    def start(self, urls):
+        if self.running:
+            return
+        self.running = True
+        thread = threading.Thread(target=self.run, args=(list(urls),), name="prober")
+        thread.daemon = True
+        thread.start()
+
+    def run(self, urls):
+        pool = ThreadPool(Config.probe_workers)
+        try:
+            results = pool.map(self.probe, urls)
+        finally:
+            pool.close()
+        self.loop.call_soon_threadsafe(lambda: self.done(urls, results))
+
+    def done(self, urls, results):
+        self.running = False
+        for url, result in zip(urls, results):
+            self.index[url] = result
+        self.store.changed()
+        alive = len([result for result in results if result['ok']])
+        info("probe: %d of %d urls reachable" % (alive, len(results)))
+        self.schedule(time.time() + Config.probe_interval)
+        if self.on_update is not None:
+            self.on_update()
+
+    def wait_slot(self):
+        # no more than probe_rate connects per second across the pool
+        with self.lock:
+            now = monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + 1.0 / Config.probe_rate
+        if slot > now:
+            time.sleep(slot - now)
+
+    def probe(self, url):
+        self.wait_slot()
+        result = {'ok': False, 'checked': int(time.time())}
+        started = time.time()
+        try:
+            request = urllib2.Request(url, headers={'Icy-MetaData': '1', 'User-Agent': 'PiRadio'})
+            response = urllib2.urlopen(request, timeout=Config.probe_timeout)
+            try:
+                headers = response.info()
+                result['latency'] = int((time.time() - started) * 1000)
+                result['type'] = headers.getheader('Content-Type')
+                result['bitrate'] = headers.getheader('icy-br')
+                result['ok'] = True
+            finally:
+                response.close()
+        except Exception as e:
+            result['error'] = str(e)
+        return result
+
+    def known(self, url):
+        return self.index.get(url)
+
+    def is_dead(self, item):
+        # dead only if every url of the station has been checked and failed
+        results = [self.known(url) for url in (item.url,) + item.alternates]
+        return all(result is not None and not result['ok'] for result in results)
+
+    def best_url(self, item):
+        candidates = []
+        for url in (item.url,) + item.alternates:
+            result = self.known(url)
+            if result is not None and result['ok']:
+                candidates.append((result.get('latency', 0), url))
+        if not candidates:
+            return item.url
+        return min(candidates)[1]
+
+
+class StreamWatchdog:
+
+    # mpd can sit in "play" on a stalled upstream with no audio. While a
+    # station plays, its status is checked every Config.watchdog_interval;
+    # the checks stop while mpd is not playing and the next idle "player"
+    # change (or the poll, without idle) starts them again.
+    # an error, or elapsed not moving for Config.stall_timeout, plays the
+    # next mirror of the station right away; once every mirror failed the
+    # retries back off. Consecutive stalls per url are kept in
+    # Config.mirrors, so the mirror that worked is the one played next time
+
+    def __init__(self, loop, program):
+        self.loop = loop
+        self.program = program
+        self.store = JsonIndex(Config.mirrors, "mirror index", loop)
+        self.index = self.store.data
+        self.station = None
+        self.url = None
+        self.elapsed = None
+        self.started = 0
+        self.progress = 0
+        self.proven = False
+        self.tried = set()
+        self.backoff = Config.watchdog_backoff_min
+        self.retry_timer = None
+        self.stalls = 0
+        self.timer = None
+        self.wake()
+
+    def failures(self, url):
+        return self.index.get(url, {}).get('stalls', 0)
+
+    def mirrors(self, item):
+        # fewest consecutive stalls first, the prober's pick breaks ties
+        urls = (item.url,) + item.alternates
+        if self.program.prober is not None:
+            first = self.program.prober.best_url(item)
+            urls = (first,) + tuple(url for url in urls if url != first)
+        return sorted(urls, key=self.failures)
+
+    def best_url(self, item):
+        return self.mirrors(item)[0]
+
+    def watch(self, idx, now):
+        self.station = idx
+        self.url = self.best_url(self.program.playlist.list[idx])
+        self.elapsed = None
+        self.started = now
+        self.progress = now
+        self.proven = False
+        self.tried = set()
+        self.backoff = Config.watchdog_backoff_min
+        self.loop.cancel(self.retry_timer)
+        self.retry_timer = None
+
+    def wake(self):
+        if self.timer is None:
+            self.timer = self.loop.call_later(Config.watchdog_interval, self.check)
+
+    def check(self):
+        self.timer = None
+        program = self.program
+        # nothing to watch while a switch or a retry is pending
+        if self.retry_timer is not None or program.active_song != program.last_active_song:
+            self.wake()
+            return
+        status = program.mpd.status()
+        if status is None:
+            # mpd is reconnecting
+            self.wake()
+            return
+        now = monotonic()
+        if program.last_active_song != self.station:
+            self.watch(program.last_active_song, now)
+        if status.get('error'):
+            self.wake()
+            self.stalled(status.get('error'))
+            return
+        if status.get('state') != 'play':
+            self.progress = now
+            return
+        self.wake()
+        if 'elapsed' in status:
+            elapsed = float(status['elapsed'])
+        elif 'time' in status:
+            elapsed = float(status['time'].split(':')[0])
+        else:
+            return
+        if elapsed != self.elapsed:
+            if self.elapsed is not None:
+                self.progress = now
+            self.elapsed = elapsed
+        if self.elapsed is not None and self.progress > self.started:
+            if not self.proven and now - self.started >= Config.watchdog_proven:
+                self.worked(status.get('bitrate'))
+            if now - self.progress >= Config.stall_timeout:
+                self.stalled("no audio for %d s" % (now - self.progress))
+        elif now - self.started >= Config.stall_connect:
+            self.stalled("no audio %d s after start" % (now - self.started))
+
+    def worked(self, bitrate):
+        self.proven = True
+        self.tried = set()
+        self.backoff = Config.watchdog_backoff_min
+        record = self.index.get(self.url, {})
+        if record.get('stalls', 0) or 'ok' not in record:
+            record.update(stalls=0, ok=int(time.time()), bitrate=bitrate)
+            self.index[self.url] = record
+            self.store.changed()
+
+    def stalled(self, reason):
+        self.stalls += 1
+        record = self.index.setdefault(self.url, {})
+        record['stalls'] = record.get('stalls', 0) + 1
+        record['failed'] = int(time.time())
+        self.store.changed()
+        item = self.program.playlist.list[self.station]
+        self.tried.add(self.url)
+        delay = 0
+        if self.tried.issuperset((item.url,) + item.alternates):
+            # every mirror failed, wait before going round again
+            delay = self.backoff
+            self.backoff = min(self.backoff * 2, Config.watchdog_backoff_max)
+            self.tried = set()
+        warning("stream stalled on %s (%s), retrying in %d s with %s" % (self.url, reason, delay, self.best_url(item)))
+        self.retry_timer = self.loop.call_later(delay, self.retry)
+
+    def retry(self):
+        self.retry_timer = None
+        program = self.program
+        if program.last_active_song != self.station or program.active_song != self.station:
+            return
+        item = program.playlist.list[self.station]
+        self.url = self.best_url(item)
+        self.elapsed = None
+        self.started = self.progress = monotonic()
+        self.proven = False
+        program.update_relay()
+        program.mpd.play(self.station, program.stream_url(item))
+
+
+class Sampler:
+
+    # statistical profiler: the main loop stack is sampled every
+    # Config.profile_interval, the result is in the folded format
+    # flamegraph.pl reads, one "outer;...;inner count" line per stack
+
+    def __init__(self, thread_id):
+        self.thread_id = thread_id
+
+    def stack(self, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def run(self, seconds):
+        counts = collections.Counter()
+        deadline = time.time() + min(seconds, Config.profile_max)
+        while time.time() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                counts[self.stack(frame)] += 1
+            time.sleep(Config.profile_interval)
+        return "".join("%s %d\n" % item for item in counts.most_common())
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path == '/metrics':
+            body = metrics.render()
+            content_type = 'text/plain; version=0.0.4'
+        elif url.path == '/profile':
+            # blocks this request for the sampling period, the loop keeps running
+            try:
+                seconds = float(urlparse.parse_qs(url.query).get('seconds', ['10'])[0])
+            except ValueError:
+                self.send_error(400)
+                return
+            body = Sampler(self.server.loop.thread_id).run(seconds)
+            content_type = 'text/plain'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, loop):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', Config.metrics_port), MetricsHandler)
+        self.loop = loop
+        thread = threading.Thread(target=self.serve_forever, name="metrics")
+        thread.daemon = True
+        thread.start()
+
+
+class ControlClient:
+
+    def __init__(self, server, conn):
+        self.server = server
+        self.conn = conn
+        self.fd = conn.fileno()
+        self.buffer = ""
+        self.out = ""
+        self.subscribed = False
+
+    def on_read(self):
+        try:
+            data = self.conn.recv(4096)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ""
+        if not data:
+            self.close()
+            return
+        self.buffer += data
+        while "\n" in self.buffer:
+            line, self.buffer = self.buffer.split("\n", 1)
+            if line.strip():
+                self.send(json.dumps(self.server.request(self, line)))
+        if len(self.buffer) > Config.control_buffer:
+            self.close()
+
+    def send(self, line):
+        if self.conn is None:
+            return
+        self.out += line + "\n"
+        self.flush()
+
+    def flush(self):
+        # whatever the socket does not take now waits for it to be writable,
+        # a client too slow to keep up with events is dropped
+        try:
+            sent = self.conn.send(self.out)
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.close()
+                return
+            sent = 0
+        self.out = self.out[sent:]
+        if not self.out:
+            self.server.loop.remove_writer(self.fd)
+        elif len(self.out) > Config.control_buffer:
+            self.close()
+        else:
+            self.server.loop.add_writer(self.fd, self.flush)
+
+    def close(self):
+        if self.conn is None:
+            return
+        self.server.loop.remove_reader(self.fd)
+        self.server.loop.remove_writer(self.fd)
+        self.server.clients.pop(self.fd, None)
+        self.conn.close()
+        self.conn = None
+
+
+class ControlServer:
+
+    # json lines on a local socket, served from the main loop. Each request
+    # line gets one response line, a json array is a batch and gets an array
+    # of responses; subscribed clients also get {"event": ...} lines
+
+    def __init__(self, loop, handler):
+        self.loop = loop
+        self.handler = handler
+        self.clients = {}
+        if Config.control_socket:
+            if os.path.exists(Config.control_socket):
+                os.unlink(Config.control_socket)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.bind(Config.control_socket)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind(('127.0.0.1', Config.control_port))
+        self.sock.listen(5)
+        self.sock.setblocking(0)
+        self.loop.add_reader(self.sock.fileno(), self.accept)
+
+    def accept(self):
+        try:
+            conn, address = self.sock.accept()
+        except socket.error:
+            return
+        conn.setblocking(0)
+        client = ControlClient(self, conn)
+        self.clients[client.fd] = client
+        self.loop.add_reader(client.fd, client.on_read)
+
+    def request(self, client, line):
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return {'ok': False, 'error': 'bad json: ' + str(e)}
+        if isinstance(request, list):
+            return [self.dispatch(client, item) for item in request]
+        return self.dispatch(client, request)
+
+    def dispatch(self, client, request):
+        if not isinstance(request, dict):
+            return {'ok': False, 'error': 'request must be an object'}
+        cmd = request.get('cmd')
+        try:
+            if cmd == 'subscribe':
+                client.subscribed = True
+            elif cmd == 'unsubscribe':
+                client.subscribed = False
+            response = self.handler(request)
+            response['ok'] = True
+        except (KeyError, ValueError, TypeError, OverflowError) as e:
+            response = {'ok': False, 'error': str(e)}
+        except Exception as e:
+            # a bad request must never take the main loop down
+            warning("control: %s failed: %r" % (cmd, e))
+            response = {'ok': False, 'error': 'internal error: %s' % e}
+        if 'id' in request:
+            response['id'] = request['id']
+        return response
+
+    def publish(self, event):
+        line = None
+        for client in self.clients.values():
+            if client.subscribed:
+                if line is None:
+                    line = json.dumps(event)
+                client.send(line)
 
 
 class Interface:
@@ -59,8 +1538,10 @@ class Interface:
     alarm_on = False
 
     stations = []
+    ready = True
+    protocol = 1
 
-    def __init__(self, encoder=0, min_value=0, max_value=0, stations=[], alarm_hours=0, alarm_minutes=0, alarm_on = False):
+    def __init__(self, encoder=0, min_value=0, max_value=0, stations=[], alarm_hours=0, alarm_minutes=0, alarm_on = False, ready=True):
         self.encoder = encoder
         self.min_value = min_value
         self.max_value = max_value
@@ -68,70 +1549,197 @@ class Interface:
         self.alarm_hours = alarm_hours
         self.alarm_minutes = alarm_minutes
         self.alarm_on = alarm_on
+        self.ready = ready
+        self.writer = SerialWriter(self)
+        # lines from the reader thread for the main loop, which waits on the
+        # read end of the pipe
+        self.lines = collections.deque()
+        self.pipe_r, self.pipe_w = os.pipe()
         self.try_serial()
 
+    def set_stations(self, stations):
+        # the station count is only known once the whole playlist is parsed,
+        # init is held back until then
+        self.stations = stations
+        self.max_value = len(stations) - 1
+        self.ready = True
+        if self.serial_connected:
+            self.send_init()
+
+    def send_range(self):
+        self.try_write('D:' + str(self.encoder) + ':' + str(self.max_value))
+
+    def set_encoder(self, value):
+        # station chosen elsewhere, the firmware encoder has to follow
+        self.encoder = value
+        if self.protocol >= 2:
+            self.try_write('ST:' + str(value))
+        else:
+            self.send_range()
+
+    def power_on(self):
+        # the power button mutes the PT2314 and drops the amplifier, an alarm
+        # has to switch them back on to be heard
+        self.try_write('PW:1')
+
+    def send_alarm(self):
+        alarm_on = 0
+        if (self.alarm_on == True):
+            alarm_on = 1
+        self.try_write('AL:' + str(self.alarm_hours) + ':' + str(self.alarm_minutes) + ':' + str(alarm_on))
+
     def send_init(self):
+        if not self.ready:
+            return
         # put some line feeds before actual init
         self.try_write("");
         self.try_write("")
+        if Config.protocol >= 2:
+            # firmware that knows framing answers PV:2, older one ignores it
+            self.try_write('PV:' + str(Config.protocol))
         self.try_write('TM:' + datetime.now().strftime("%H:%M"))
-        alarm_on = 0
-        if (self.alarm_on == True):
-            alarm_on = 1
-        self.try_write('AL:' + str(self.alarm_hours) + ':' + str(self.alarm_minutes) + ':' + str(alarm_on))
+        self.send_alarm()
         self.try_write('D:' + str(self.encoder) + ':' + str(self.max_value))
 
+    def devices(self):
+        # serial_dev entries may be globs, e.g. /dev/serial/by-id/usb-FTDI_*
+        found = []
+        for pattern in Config.serial_dev:
+            for path in sorted(glob.glob(pattern)):
+                if path not in found:
+                    found.append(path)
+        return found
+
     def try_serial(self):
-        for serial_dev in Config.serial_dev:
-            if not self.serial_connected:
-                try:
-                    self.serial = serial.Serial(serial_dev, Config.serial_speed)
-                    time.sleep(Config.init_delay)
-                    self.serial_connected = True
-                    self.send_init()
-                    debug("serial port: " + serial_dev)
-                except Exception as e:
-                    debug(e)
-                    self.serial_connected = False
+        if self.serial_connected:
+            return True
+        self.close_serial()
+        for serial_dev in self.devices():
+            try:
+                port = serial.Serial(serial_dev, Config.serial_speed, timeout=Config.read_timeout)
+            except Exception as e:
+                warning(e)
+                continue
+            time.sleep(Config.init_delay)
+            self.serial = port
+            self.serial_connected = True
+            self.protocol = 1
+            self.writer.clear()
+            thread = threading.Thread(target=self.read_port, args=(port,), name="serial-reader")
+            thread.daemon = True
+            thread.start()
+            self.send_init()
+            info("serial port: " + serial_dev)
+            return True
+        return False
+
+    def close_serial(self):
+        # a port that went away is closed before the next one is opened
+        port = self.serial
+        self.serial = None
+        if port is not None:
+            try:
+                port.close()
+            except Exception as e:
+                pass
 
     def try_write(self, data):
+        # never blocks, the writer thread paces the actual output
+        if not self.serial_connected:
+            return False
+        if isinstance(data, unicode):
+            data = data.encode('ascii', 'ignore')
+        self.writer.put(data)
+        return True
+
+    def write(self, data):
+        port = self.serial
+        if port is None:
+            return False
         try:
-            self.serial.write(data + "\r\n")
-            debug("write: " + data)
-            time.sleep(Config.write_delay)
+            port.write(data)
             return True
         except Exception as e:
-            self.serial_connected = False
-            self.try_serial()
+            warning(e)
+            if port is self.serial:
+                self.serial_connected = False
             return False
 
+    def fileno(self):
+        if self.serial_connected:
+            return self.pipe_r
+        return None
+
+    def read_port(self, port):
+        # one thread per open port. Acks go to the writer from here, so a
+        # busy main loop cannot make a frame look lost; every other line is
+        # queued for the main loop
+        data = ""
+        while port is self.serial:
+            try:
+                chunk = port.read(max(1, port.inWaiting()))
+            except (serial.SerialException, IOError, OSError, TypeError, AttributeError) as e:
+                if port is self.serial:
+                    warning("serial read failed: " + str(e))
+                    self.serial_connected = False
+                    os.write(self.pipe_w, "x")
+                return
+            data += chunk
+            while "\n" in data:
+                ln, data = data.split("\n", 1)
+                ln = ln.strip()
+                if ln.startswith(('K:', 'N:')):
+                    self.process_line(ln)
+                elif ln:
+                    self.lines.append(ln)
+                    os.write(self.pipe_w, "x")
+
     def try_read(self):
+        # lines the reader thread queued, None once the port is gone
+        os.read(self.pipe_r, 4096)
         init_request = False
-        try:
-            if self.serial_connected and self.serial.inWaiting():
-                ln = self.serial.readline()
-                ln = ln.strip()
-                debug("read: " + ln)
-                if ln == "init":
-                    time.sleep(Config.init_delay)
-                    self.send_init()
-                    init_request = True
-                elif ln != "":
-                    parts = ln.split(":")
-                    if (parts[0] == 'E'):
-                        self.encoder = int(parts[1])
-                    if (parts[0] == 'A'):
-                        self.alarm_hours = parts[1]
-                        self.alarm_minutes = parts[2]
-                        if (parts[3] == '1'):
-                            self.alarm_on = True
-                        else:
-                            self.alarm_on = False
-            elif not self.serial_connected:
-                self.try_serial()
-            return init_request
-        except Exception as e:
+        while self.lines:
+            if self.process_line(self.lines.popleft()):
+                init_request = True
+        if not self.serial_connected:
             return None
+        return init_request
+
+    def process_line(self, ln):
+        debug("read: " + ln)
+        trace.record('rx', ln)
+        try:
+            return self.apply_line(ln)
+        except (ValueError, IndexError) as e:
+            # line noise (boot garbage on the uart, a torn line) is skipped,
+            # the port stays open
+            warning("bad serial line %r: %s" % (ln, e))
+            return False
+
+    def apply_line(self, ln):
+        if ln == "init":
+            self.protocol = 1
+            time.sleep(Config.init_delay)
+            self.send_init()
+            return True
+        elif ln != "":
+            parts = ln.split(":")
+            if (parts[0] == 'K' or parts[0] == 'N'):
+                self.writer.ack(int(parts[1], 16), parts[0] == 'K')
+            if (parts[0] == 'PV'):
+                self.protocol = min(int(parts[1]), Config.protocol)
+                info("protocol: " + str(self.protocol))
+            if (parts[0] == 'E'):
+                self.encoder = int(parts[1])
+            if (parts[0] == 'V'):
+                self.volume = max(self.min_volume, min(self.max_volume, int(parts[1])))
+            if (parts[0] == 'A'):
+                # parsed as a whole, a short line leaves the alarm untouched
+                hours, minutes, on = int(parts[1]), int(parts[2]), parts[3] == '1'
+                self.alarm_hours = hours
+                self.alarm_minutes = minutes
+                self.alarm_on = on
+        return False
 
 
 class PollerError(Exception):
@@ -140,25 +1748,44 @@ class PollerError(Exception):
 
 class MPDWrapper:
 
-    def __init__(self, host="localhost", port="6600", password=None):
+    def __init__(self, host="localhost", port="6600", password=None, loop=None):
         self._host = host
         self._port = port
         self._password = password
-        self._client = MPDClient()
+        self._client = self.new_client()
+        self._idle = None
+        self.loop = loop
+        self.connected = False
+        self.connecting = False
+        self.backoff = Config.mpd_backoff_min
+        self.pending = collections.OrderedDict()
+        self.reconnects = 0
+        self.on_reconnect = None
+        self.idle_started = 0
+        self.idle_connecting = False
+        self.round_trips = 0
+
+    def new_client(self):
+        client = MPDClient()
+        client.timeout = Config.mpd_timeout
+        return client
+
+    def connect(self, client=None):
+        if client is None:
+            client = self._client
 
-    def connect(self):
         try:
-            self._client.connect(self._host, self._port)
+            client.connect(self._host, self._port)
 
-        except IOError as (errno, strerror):
-            raise PollerError("Could not connect to '%s': %s" % (self._host, strerror))
+        except IOError as e:
+            raise PollerError("Could not connect to '%s': %s" % (self._host, e))
 
         except MPDError as e:
             raise PollerError("Could not connect to '%s': %s" % (self._host, e))
 
         if self._password:
             try:
-                self._client.password(self._password)
+                client.password(self._password)
 
             except CommandError as e:
                 raise PollerError("Could not connect to '%s': "
@@ -171,6 +1798,8 @@ class MPDWrapper:
                                   (self._host, e))
 
     def disconnect(self):
+        self.connected = False
+
         try:
             self._client.close()
 
@@ -181,87 +1810,246 @@ class MPDWrapper:
             self._client.disconnect()
 
         except (MPDError, IOError):
-            self._client = MPDClient()
-
-    def currentsong(self):
+            self._client = self.new_client()
 
+    def open(self):
+        # first connection, a failure is retried in the background
         try:
-            self._client.command_list_ok_begin()
-            self._client.currentsong()
-            song = self._client.command_list_end()
-
-        except (MPDError, IOError):
-            self.disconnect()
-
+            self.connect()
+            self.connected = True
+        except PollerError as e:
+            warning(str(e))
+            self.schedule_reconnect()
+        return self.connected
+
+    def execute(self, name, command, replay=False):
+        # run command(client) on the command connection. A dropped connection
+        # (mpd closes idle clients after its connection_timeout) is reconnected
+        # in the background, never on the loop thread; replayable commands
+        # wait for it, the latest one per name
+        if self.connected:
             try:
-                self.connect()
-
-            except PollerError as e:
-                raise PollerError("Reconnecting failed: %s" % e)
+                started = time.time()
+                result = command(self._client)
+                elapsed = time.time() - started
+                metrics.mpd_time.observe(elapsed, name)
+                trace.record('mpd', {'cmd': name, 'ms': round(elapsed * 1000, 3), 'result': trace.result(result)})
+                return result
 
-            try:
-                self._client.command_list_ok_begin()
-                self._client.currentsong()
-                song = self._client.command_list_end()
+            except CommandError as e:
+                warning("mpd %s failed: %s" % (name, e))
+                trace.record('mpd', {'cmd': name, 'error': str(e)})
+                return None
 
             except (MPDError, IOError) as e:
-                raise PollerError("Couldn't retrieve current song: %s" % e)
-
-        return song
-
-    def load_playlist(self, list):
+                trace.record('mpd', {'cmd': name, 'error': str(e)})
+                warning("mpd %s failed: %s" % (name, e))
+                self.disconnect()
+
+        if replay:
+            self.pending.pop(name, None)
+            self.pending[name] = command
+            while len(self.pending) > Config.mpd_queue:
+                self.pending.popitem(last=False)
+        self.schedule_reconnect()
+        return None
+
+    def schedule_reconnect(self):
+        if self.connected or self.connecting or self.loop is None:
+            return
+        self.connecting = True
+        info("mpd: reconnecting in %.1f s" % self.backoff)
+        self.loop.call_later(self.backoff, self.reconnect)
+
+    def reconnect(self):
+        # connect on a thread, the loop never waits for a tcp handshake
+        thread = threading.Thread(target=self.try_reconnect, name="mpd-reconnect")
+        thread.daemon = True
+        thread.start()
+
+    def try_reconnect(self):
+        client = self.new_client()
         try:
-            self._client.command_list_ok_begin()
-            self._client.stop()
-            self._client.clear()
-            for item in list:
-                self._client.add(item.url)
-            self._client.command_list_end()
-
-        except (MPDError, IOError):
-            self.disconnect()
-
+            self.connect(client)
+            ok = True
+        except PollerError as e:
+            warning(str(e))
+            ok = False
+        self.loop.call_soon_threadsafe(lambda: self.reconnected(client, ok))
+
+    def reconnected(self, client, ok):
+        self.connecting = False
+        if not ok:
+            self.backoff = min(self.backoff * 2, Config.mpd_backoff_max)
+            self.schedule_reconnect()
+            return
+
+        self._client = client
+        self.connected = True
+        self.backoff = Config.mpd_backoff_min
+        self.reconnects += 1
+        info("mpd: reconnected, replaying %d commands" % len(self.pending))
+        pending = self.pending
+        self.pending = collections.OrderedDict()
+        for name, command in pending.items():
+            self.execute(name, command, replay=True)
+        if self.on_reconnect is not None:
+            self.on_reconnect()
+
+    def batch(self, client, commands):
+        # pipelined: all commands in a single command list and round trip
+        client.command_list_ok_begin()
+        for command in commands:
+            getattr(client, command[0])(*command[1:])
+        return client.command_list_end()
+
+    def start_idle(self, callback):
+        # idle subscription on its own connection, so commands sent on the
+        # main connection are never blocked behind a pending idle. Connects
+        # on a thread, callback(fd) runs on the loop, fd None without idle
+        if self.idle_connecting:
+            return
+        self.stop_idle()
+        self.idle_connecting = True
+        thread = threading.Thread(target=self.connect_idle, args=(callback,), name="mpd-idle")
+        thread.daemon = True
+        thread.start()
+
+    def connect_idle(self, callback):
+        client = self.new_client()
+        try:
+            self.connect(client)
+            if tuple(int(part) for part in client.mpd_version.split(".")[:2]) < (0, 14):
+                raise PollerError("MPD %s has no idle support" % client.mpd_version)
+            client.timeout = None
+            client.send_idle('player', 'playlist', 'mixer')
+        except (PollerError, MPDError, IOError, ValueError) as e:
+            info("idle unavailable, polling: %s" % e)
             try:
-                self.connect()
+                client.disconnect()
+            except (MPDError, IOError):
+                pass
+            client = None
+        self.loop.call_soon_threadsafe(lambda: self.idle_connected(client, callback))
+
+    def idle_connected(self, client, callback):
+        self.idle_connecting = False
+        if client is None:
+            callback(None)
+            return
+        self._idle = client
+        if not self.idle_started:
+            self.idle_started = monotonic()
+            self.round_trips = 0
+        callback(client.fileno())
+
+    def fetch_idle(self):
+        try:
+            changes = self._idle.fetch_idle()
+            self._idle.send_idle('player', 'playlist', 'mixer')
+            return changes
 
-            except PollerError as e:
-                raise PollerError("Reconnecting failed: %s" % e)
+        except (MPDError, IOError) as e:
+            warning("idle connection lost: %s" % e)
+            self.stop_idle()
+            return None
 
+    def stop_idle(self):
+        if self._idle is not None:
             try:
-                self._client.command_list_ok_begin()
-                self._client.stop()
-                self._client.clear()
-                for item in list:
-                    self._client.add(item.url)
-                self._client.command_list_end()
-
-            except (MPDError, IOError) as e:
-                raise PollerError("Couldn't load playlist: %s" % e)
-
-    def play(self, idx):
-        try:
-            self._client.command_list_ok_begin()
-            self._client.stop()
-            self._client.play(idx)
-            self._client.command_list_end()
+                self._idle.disconnect()
+            except (MPDError, IOError):
+                pass
+            self._idle = None
+
+    def round_trips_saved(self):
+        # polls the old 500ms loop would have made minus the fetches idle needed
+        if not self.idle_started:
+            return 0
+        polls = int((monotonic() - self.idle_started) / Config.poll_delay)
+        return max(0, polls - self.round_trips)
 
-        except (MPDError, IOError):
-            self.disconnect()
+    def currentsong(self):
+        self.round_trips += 1
+        return self.execute('currentsong', lambda client: self.batch(client, [('currentsong',)]))
+
+    def sync_playlist(self, urls, active=None):
+        return self.execute('sync', lambda client: self._sync_playlist(client, urls, active), replay=True)
+
+    def _sync_playlist(self, client, urls, active):
+        # start the saved station first, the rest of the queue is reconciled
+        # while it is already buffering
+        if active is not None and 0 <= active < len(urls):
+            self._start(client, urls[active])
+
+        queue = [(song['id'], song['file']) for song in client.playlistinfo()]
+        ops = self.diff_queue(queue, urls)
+        if ops:
+            self.batch(client, ops)
+        info("playlist sync: %d of %d queue entries changed" % (len(ops), len(urls)))
+        return len(ops)
+
+    def start(self, url):
+        self.execute('play', lambda client: self._start(client, url), replay=True)
+
+    def _start(self, client, url):
+        # play url from its existing queue entry, or append it; a station that
+        # is already playing is left alone. playlistfind asks mpd for the one
+        # entry instead of listing the whole queue
+        songs = client.playlistfind('file', url)
+        if songs:
+            playing = songs[0]['id']
+        else:
+            playing = client.addid(url)
+        status = client.status()
+        if status.get('songid') != playing or status.get('state') != 'play':
+            client.playid(playing)
+
+    def diff_queue(self, queue, urls):
+        # (id, file) pairs in queue order -> addid/deleteid/moveid commands
+        # turning the queue into urls, entries that only shift keep their id
+        ops = []
+        needed = collections.Counter(urls)
+        kept = []
+        for songid, file in queue:
+            if needed[file] > 0:
+                needed[file] -= 1
+                kept.append((songid, file))
+            else:
+                ops.append(('deleteid', songid))
+
+        for pos, url in enumerate(urls):
+            if pos < len(kept) and kept[pos][1] == url:
+                continue
+            for j in range(pos + 1, len(kept)):
+                if kept[j][1] == url:
+                    entry = kept.pop(j)
+                    kept.insert(pos, entry)
+                    ops.append(('moveid', entry[0], pos))
+                    break
+            else:
+                kept.insert(pos, (None, url))
+                ops.append(('addid', url, pos))
+        return ops
 
-            try:
-                self.connect()
+    def play(self, idx, url=None):
+        self.execute('play', lambda client: self._play(client, idx, url), replay=True)
 
-            except PollerError as e:
-                raise PollerError("Reconnecting failed: %s" % e)
+    def _play(self, client, idx, url):
+        # a different url for the station replaces its queue entry in place
+        if url is not None:
+            songs = client.playlistinfo(idx)
+            if songs and songs[0]['file'] != url:
+                self.batch(client, [('stop',), ('addid', url, idx), ('deleteid', songs[0]['id']), ('play', idx)])
+                return
+        self.batch(client, [('stop',), ('play', idx)])
 
-            try:
-                self._client.command_list_ok_begin()
-                self._client.stop()
-                self._client.play(idx)
-                self._client.command_list_end()
+    def setvol(self, volume):
+        self.execute('setvol', lambda client: client.setvol(volume), replay=True)
 
-            except (MPDError, IOError) as e:
-                raise PollerError("Couldn't play song: %s" % e)
+    def status(self):
+        self.round_trips += 1
+        return self.execute('status', lambda client: client.status())
 
 
 class Program:
@@ -274,157 +2062,913 @@ class Program:
     alarm_hours = 0
     alarm_minutes = 0
     alarm_on = False
-    alarm_changed = False
     last_active_song = 0
     last_changed = 0
-    last_alarm_changed = 0
     last_time = 0
     interface = None
+    loop = None
+    relay = None
+    prober = None
+    watchdog = None
+    history = None
 
     def __init__(self):
         self.begin()
 
     def millis(self):
-        return int(round(time.time() * 1000))
+        return int(round(monotonic() * 1000))
+
+    def source_url(self, item):
+        # the mirror that last played without stalling, else the fastest
+        # reachable one when the prober knows one
+        if self.watchdog is not None:
+            return self.watchdog.best_url(item)
+        if self.prober is not None:
+            return self.prober.best_url(item)
+        return item.url
+
+    def stream_url(self, item):
+        # what mpd plays: the station url itself or its local relay url
+        if self.relay is not None:
+            return self.relay.url_for(self.source_url(item))
+        return self.source_url(item)
+
+    def stream_urls(self, items):
+        return [self.stream_url(item) for item in items]
+
+    def update_relay(self):
+        # keep the active station and its encoder neighbours connected
+        if self.relay is None:
+            return
+        items = self.playlist.list
+        self.relay.allow([url for item in items for url in (item.url,) + item.alternates])
+        low = max(0, self.active_song - Config.relay_neighbours)
+        high = min(len(items), self.active_song + Config.relay_neighbours + 1)
+        self.relay.warm([self.source_url(item) for item in items[low:high]])
 
     def begin(self):
 
-        # load playlist
-        self.playlist = Playlist()
-        self.playlist.load(Config.playlist)
-
-        # init mpd
-        self.mpd = MPDWrapper(Config.mpd_host, Config.mpd_port, Config.mpd_password)
-        self.mpd.connect()
-        self.mpd.load_playlist(self.playlist.list)
+        timer = StartupTimer()
+        if Config.trace:
+            trace.open(Config.trace, protocol=Config.protocol, playlist=Config.playlist, serial_speed=Config.serial_speed)
+        self.loop = EventLoop()
+        if Config.relay:
+            self.relay = StreamRelay(self.loop)
+        if Config.probe:
+            self.prober = StationProber(self.loop)
+        if Config.watchdog:
+            self.watchdog = StreamWatchdog(self.loop, self)
 
         # get active song from saved state
-        self.state = State()
+        self.state = State(self.loop)
         if self.state.load():
             self.active_song = self.state.active_menu
             self.alarm_hours = self.state.alarm_hours
             self.alarm_minutes = self.state.alarm_minutes
             self.alarm_on = self.state.alarm_on
-            self.last_active_song = self.active_song
+            self.active_volume = self.state.get('volume', self.active_volume)
+        self.history = SongHistory()
+        self.history.load()
+        timer.phase("state")
 
-        # init serial encoder instance
-        self.interface = Interface(self.active_song, 0, len(self.playlist.list) - 1, self.playlist.list, self.alarm_hours, self.alarm_minutes, self.alarm_on)
+        # read only as far as the saved station and start it right away
+        self.playlist = Playlist()
+        station = self.playlist.peek(Config.playlist, self.active_song)
+        timer.phase("peek")
 
-        # play active song
-        self.mpd.play(self.active_song)
+        self.mpd = MPDWrapper(Config.mpd_host, Config.mpd_port, Config.mpd_password, self.loop)
+        self.mpd.open()
+        timer.phase("mpd connect")
 
-        # run scene
-        Main(self)
+        # the knob position from the last run, until the firmware reports it
+        if self.state.get('volume') is not None:
+            self.mpd.setvol(self.active_volume)
 
+        if station is not None:
+            if self.relay is not None:
+                self.relay.allow((station.url,) + station.alternates)
+            self.mpd.start(self.stream_url(station))
+            timer.phase("play")
+            timer.check_budget()
 
-class Main:
+        # serial handshake runs while the full playlist is parsed and synced
+        serial_thread = threading.Thread(target=self.start_interface, args=(timer,), name="serial-init")
+        serial_thread.start()
 
-    program = None
-    last_current_song = 0
-    current_song = ''
+        self.playlist.load(Config.playlist)
+        timer.phase("playlist")
 
-    texts = ['', '', '', '', '']
-    last_texts = ['---', '---', '---', '---', '---']
+        if self.active_song >= len(self.playlist.list):
+            self.active_song = 0
+        self.last_active_song = self.active_song
+        trace.record('playlist', {'stations': len(self.playlist.list), 'active': self.active_song})
 
-    def __init__(self, program):
-        self.begin(program)
+        if self.prober is not None:
+            self.prober.set_stations(self.playlist.list)
+        self.update_relay()
+        self.mpd.sync_playlist(self.stream_urls(self.playlist.list), self.active_song)
+        timer.phase("sync")
 
-    def begin(self, program):
+        serial_thread.join()
+        self.interface.encoder = self.active_song
+        self.interface.volume = self.active_volume
+        self.interface.set_stations(self.playlist.list)
+        timer.phase("ready")
 
-        self.program = program
+        if Config.metrics_port:
+            self.start_metrics()
 
-        while True:
+        # run scene
+        Main(self)
 
-            init_request = self.program.interface.try_read()
-            if init_request:
-                self.last_texts = ['', '', '', '', '']
+    def start_metrics(self):
+        metrics.counter("radio_mpd_reconnects_total", "MPD reconnects", lambda: self.mpd.reconnects)
+        metrics.counter("radio_state_writes_total", "State file writes", lambda: self.state.writes)
+        metrics.counter("radio_state_updates_total", "State changes, merged into fewer writes", lambda: self.state.updates)
+        metrics.counter("radio_loop_wakeups_total", "Main loop wakeups", lambda: self.loop.wakeups)
+        if self.watchdog is not None:
+            metrics.counter("radio_stream_stalls_total", "Stalled streams restarted by the watchdog", lambda: self.watchdog.stalls)
+        metrics.counter("radio_history_writes_total", "Titles written to the history log", lambda: self.history.writes)
+        metrics.counter("radio_history_syncs_total", "History log fsyncs", lambda: self.history.syncs)
+        metrics.counter("radio_serial_retries_total", "Frames sent again for a missing ack", lambda: self.interface.writer.retries)
+        metrics.gauge("radio_serial_connected", "Serial port open", lambda: int(self.interface.serial_connected))
+        metrics.gauge("radio_mpd_connected", "MPD command connection up", lambda: int(self.mpd.connected))
+        try:
+            MetricsServer(self.loop)
+        except socket.error as e:
+            warning("metrics unavailable: " + str(e))
 
-            if self.program.interface.encoder != self.program.active_song:
-                self.program.active_song = self.program.interface.encoder
-                self.program.last_changed = self.program.millis()
+    def start_interface(self, timer):
+        started = time.time()
+        self.interface = Interface(self.active_song, 0, 0, [], self.alarm_hours, self.alarm_minutes, self.alarm_on, ready=False)
+        timer.report("serial", time.time() - started)
 
-            if self.program.interface.volume != self.program.active_volume:
-                self.program.active_volume = self.program.interface.volume
 
-            if self.program.interface.alarm_hours != self.program.alarm_hours or self.program.interface.alarm_minutes != self.program.alarm_minutes or self.program.interface.alarm_on != self.program.alarm_on:
-                self.program.alarm_hours = self.program.interface.alarm_hours
-                self.program.alarm_minutes = self.program.interface.alarm_minutes
-                self.program.alarm_on = self.program.interface.alarm_on
-                self.program.last_alarm_changed = self.program.millis()
-                self.program.alarm_changed = True
+class StartupTimer:
 
-            if self.program.millis() - self.program.last_changed >= Config.save_timeout and self.program.last_active_song != self.program.active_song:
-                self.program.last_active_song = self.program.active_song
-                self.program.mpd.play(self.program.active_song)
-                self.program.state.save(self.program.active_song, self.program.alarm_hours, self.program.alarm_minutes, self.program.alarm_on)
+    def __init__(self):
+        self.started = time.time()
+        self.last = self.started
+
+    def report(self, name, duration):
+        info("startup: %s %d ms (%d ms since start)" % (name, duration * 1000, (time.time() - self.started) * 1000))
+
+    def phase(self, name):
+        now = time.time()
+        self.report(name, now - self.last)
+        self.last = now
+
+    def check_budget(self):
+        elapsed = time.time() - self.started
+        if elapsed > Config.startup_budget:
+            warning("startup: boot to audio took %d ms, budget is %d ms" % (elapsed * 1000, Config.startup_budget * 1000))
+
+
+def translit_table():
+    # unicode.translate table, built once: what the ascii font of the OLED
+    # can show for cyrillic, latin with diacritics and typographic punctuation
+    table = {}
+    for code in range(0xc0, 0x250):
+        base = unicodedata.normalize('NFKD', unichr(code)).encode('ascii', 'ignore')
+        if base:
+            table[code] = unicode(base)
+    latin = {
+        u'ß': u'ss', u'æ': u'ae', u'Æ': u'AE', u'œ': u'oe', u'Œ': u'OE',
+        u'ø': u'o', u'Ø': u'O', u'ł': u'l', u'Ł': u'L', u'đ': u'd', u'Đ': u'D',
+        u'ð': u'd', u'Ð': u'D', u'þ': u'th', u'Þ': u'Th', u'ı': u'i', u'ħ': u'h',
+        u'Ħ': u'H', u'ŧ': u't', u'Ŧ': u'T', u'ŋ': u'ng', u'Ŋ': u'Ng',
+    }
+    cyrillic = {
+        u'а': u'a', u'б': u'b', u'в': u'v', u'г': u'g', u'д': u'd', u'е': u'e',
+        u'ё': u'yo', u'ж': u'zh', u'з': u'z', u'и': u'i', u'й': u'y', u'к': u'k',
+        u'л': u'l', u'м': u'm', u'н': u'n', u'о': u'o', u'п': u'p', u'р': u'r',
+        u'с': u's', u'т': u't', u'у': u'u', u'ф': u'f', u'х': u'kh', u'ц': u'ts',
+        u'ч': u'ch', u'ш': u'sh', u'щ': u'shch', u'ъ': u'', u'ы': u'y', u'ь': u'',
+        u'э': u'e', u'ю': u'yu', u'я': u'ya', u'є': u'ye', u'і': u'i', u'ї': u'yi',
+        u'ґ': u'g', u'ў': u'u', u'ђ': u'dj', u'ј': u'j', u'љ': u'lj', u'њ': u'nj',
+        u'ћ': u'c', u'џ': u'dz', u'ѓ': u'gj', u'ќ': u'kj', u'ѕ': u'dz',
+    }
+    punctuation = {
+        u'\u2018': u"'", u'\u2019': u"'", u'\u201a': u"'", u'\u201b': u"'",
+        u'\u2032': u"'", u'\u201c': u'"', u'\u201d': u'"', u'\u201e': u'"',
+        u'\u201f': u'"', u'\u2033': u'"', u'\u00ab': u'"', u'\u00bb': u'"',
+        u'\u2039': u'<', u'\u203a': u'>', u'\u2010': u'-', u'\u2011': u'-',
+        u'\u2012': u'-', u'\u2013': u'-', u'\u2014': u'-', u'\u2015': u'-',
+        u'\u2212': u'-', u'\u2026': u'...', u'\u2022': u'*', u'\u00b7': u'.',
+        u'\u00a0': u' ', u'\u2009': u' ', u'\u202f': u' ', u'\u2044': u'/',
+        u'\u00d7': u'x', u'\u2116': u'No', u'\u2122': u'TM', u'\u00a9': u'(C)',
+        u'\u00ae': u'(R)', u'\u20ac': u'EUR', u'\u00a3': u'GBP', u'\u00b0': u'',
+    }
+    for char, text in latin.items() + punctuation.items():
+        table[ord(char)] = text
+    for char, text in cyrillic.items():
+        table[ord(char)] = text
+        table[ord(char.upper())] = text.capitalize()
+    return table
+
+
+TRANSLIT = translit_table()
+
+translit_cache = collections.OrderedDict()
+
+
+def to_ascii(text):
+    # memoized, titles repeat on every refresh and stations on every reload
+    result = translit_cache.pop(text, None)
+    if result is None:
+        result = transliterate(text)
+        if len(translit_cache) >= Config.translit_cache:
+            translit_cache.popitem(last=False)
+    translit_cache[text] = result
+    return result
+
+
+def transliterate(text):
+    try:
+        if not isinstance(text, unicode):
+            text = text.decode('utf-8', 'replace')
+        text = text.translate(TRANSLIT)
+        try:
+            return text.encode('ascii')
+        except UnicodeEncodeError:
+            # whatever the table misses keeps at least its base letter
+            return unicodedata.normalize('NFKD', text).translate(TRANSLIT).encode('ascii', 'ignore')
+    except Exception as e:
+        return text
 
-            if self.program.millis() - self.program.last_alarm_changed >= Config.save_timeout and self.program.alarm_changed:
-                self.program.state.save(self.program.active_song, self.program.alarm_hours, self.program.alarm_minutes, self.program.alarm_on)
-                self.program.alarm_changed = False
 
-            # fetch time
-            self.texts[4] = datetime.now().strftime("%H:%M")
-            if (self.texts[4] != self.last_texts[4]):
-                self.program.interface.try_write('TM:' + self.texts[4])
-                self.last_texts[4] = self.texts[4]
+class Layout:
 
-            # fetch current song from mpd every 500ms
-            if self.program.millis() - self.last_current_song > 500:
-                current_song = self.program.mpd.currentsong()
+    def __init__(self):
+        self.stations = []
+        self.titles = collections.OrderedDict()
+
+    def set_stations(self, items):
+        # station rows are computed once per playlist load
+        self.stations = [self.station_row(item.name) for item in items]
+
+    def station_row(self, name):
+        part = textwrap.wrap(to_ascii(name), Config.COLS)
+        if part:
+            return part[0].upper()
+        return ''
+
+    def station(self, idx):
+        if 0 <= idx < len(self.stations):
+            return self.stations[idx]
+        return ''
+
+    def title_frames(self, title):
+        # tuple of (row1, row2) frames, more than one frame means marquee
+        frames = self.titles.pop(title, None)
+        if frames is None:
+            frames = self.wrap_title(title)
+            if len(self.titles) >= Config.layout_cache:
+                self.titles.popitem(last=False)
+        self.titles[title] = frames
+        return frames
+
+    def wrap_title(self, title):
+        text = to_ascii(title).upper()
+        part = textwrap.wrap(text, Config.COLS - 1)
+        if len(part) < 2:
+            return (('', text),)
+        return tuple((part[i], part[i + 1]) for i in range(0, len(part) - 1))
+
+
+class AlarmScheduler:
+
+    def __init__(self, loop, program):
+        self.loop = loop
+        self.program = program
+        self.timer = None
+        self.ramp_timer = None
+        self.armed = None
+        self.listening = False
+        self.volume = 0
+        self.ramp_from = 0
+        self.ramp_started = 0
+        self.fired = program.state.get('alarm_fired', '')
+        self.schedule()
+
+    def next_alarm(self, now):
+        alarm = now.replace(hour=int(self.program.alarm_hours), minute=int(self.program.alarm_minutes), second=0, microsecond=0)
+        # an alarm that fired already or is more than alarm_grace late is tomorrow's
+        if self.key(alarm) == self.fired or now - alarm > timedelta(seconds=Config.alarm_grace):
+            alarm += timedelta(days=1)
+        return alarm
+
+    def key(self, alarm):
+        return alarm.strftime("%Y-%m-%d-%H-%M")
+
+    def schedule(self):
+        # deadlines are recomputed from the wall clock at least once a minute,
+        # so a clock step (ntp after boot) moves them instead of breaking them
+        self.loop.cancel(self.timer)
+        self.timer = None
+        if not self.program.alarm_on:
+            self.armed = None
+            return
+
+        now = datetime.now()
+        alarm = self.next_alarm(now)
+        prebuffer = alarm - timedelta(seconds=Config.alarm_prebuffer)
+        if now >= alarm:
+            self.fire(alarm)
+            self.schedule()
+            return
+        if now >= prebuffer:
+            self.prebuffer(alarm)
+            delay = (alarm - now).total_seconds()
+        else:
+            delay = min(60, (prebuffer - now).total_seconds())
+        self.timer = self.loop.call_later(delay, self.schedule)
+
+    def playing(self):
+        status = self.program.mpd.status()
+        return status is not None and status.get('state') == 'play'
+
+    def prebuffer(self, alarm):
+        # connect and fill the stream buffer at zero volume ahead of time,
+        # unless someone is listening already
+        if self.armed == alarm:
+            return
+        self.armed = alarm
+        self.listening = self.playing()
+        if self.listening:
+            info("alarm: already playing, no prebuffer for " + alarm.strftime("%H:%M"))
+            return
+        info("alarm: prebuffering for " + alarm.strftime("%H:%M"))
+        self.loop.cancel(self.ramp_timer)
+        self.program.mpd.setvol(0)
+        self.program.mpd.play(self.program.active_song)
+
+    def fire(self, alarm):
+        self.fired = self.key(alarm)
+        self.program.state.update(alarm_fired=self.fired)
+        if self.armed != alarm:
+            # restarted inside the grace period, no time left to prebuffer
+            self.listening = self.playing()
+            if not self.listening:
+                self.program.mpd.setvol(0)
+                self.program.mpd.play(self.program.active_song)
+        self.armed = None
+        info("alarm: " + alarm.strftime("%H:%M"))
+        self.program.interface.power_on()
+        # a station that was already playing starts from its volume
+        self.ramp_from = self.program.active_volume if self.listening else 0
+        self.ramp_started = monotonic()
+        self.listening = False
+        self.loop.cancel(self.ramp_timer)
+        self.ramp()
+
+    def target(self):
+        # up to where the knob is, but never to a knob position that was
+        # never reported (protocol 1 sends no V:) or turned all the way down
+        return max(self.program.active_volume, Config.alarm_volume)
+
+    def ramp(self):
+        # the volume follows the elapsed time, so the ramp takes alarm_ramp
+        # seconds whatever the target and however late the ticks run
+        target = self.target()
+        elapsed = monotonic() - self.ramp_started
+        fraction = min(1.0, elapsed / Config.alarm_ramp) if Config.alarm_ramp > 0 else 1.0
+        self.volume = max(self.ramp_from, int(round(self.ramp_from + (target - self.ramp_from) * fraction)))
+        self.program.mpd.setvol(self.volume)
+        if fraction < 1:
+            self.ramp_timer = self.loop.call_later(1, self.ramp)
+        else:
+            self.ramp_timer = None
 
-                if current_song is not None and current_song != '' and 'title' in current_song[0]:
-                    title = current_song[0]['title'].strip()
 
-                    try:
-                        title = title.decode('utf-8')
-                        title = title.encode('ascii', 'ignore')
-                    except Exception as e:
-                        pass
+class Main:
 
-                    if title != self.current_song:
-                        self.current_song = title.upper()
-                else:
-                    self.current_song = ''
+    program = None
+    loop = None
+    layout = None
+    alarm = None
+    current_song = ''
+    song_frames = (('', ''),)
+    frame = 0
+    marquee_timer = None
+    serial_fd = None
+    serial_timer = None
+    serial_backoff = 0
+    mpd_fd = None
+    poll_timer = None
+    last_idle_attempt = 0
+    play_timer = None
+    last_move = 0
+    step_gap = None
+    control = None
+    volume_timer = None
+    last_setvol = 0
+
+    # station, song row 1, song row 2, clock as last sent to the firmware,
+    # None forces a resend
+    last_rows = (None, None, None, None)
 
-                self.last_current_song = self.program.millis()
+    def __init__(self, program):
+        self.begin(program)
 
-            # print station title
-            station = self.program.playlist.list[self.program.active_song]
-            part = textwrap.wrap(station.name, 21);
-            self.texts[0] = part[0].upper()
-            if self.texts[0] != self.last_texts[0]:
-                self.program.interface.try_write('S0:' + self.texts[0])
-                self.last_texts[0] = self.texts[0]
-
-            part = textwrap.wrap(self.current_song, 20)
-            if len(part) >= 2:
-                self.texts[2] = part[0]
-                self.texts[3] = part[1]
-            else:
-                self.texts[2] = ''
-                self.texts[3] = self.current_song
+    def begin(self, program):
 
-            if self.texts[2] != self.last_texts[2]:
-                self.program.interface.try_write('S1:' + self.texts[2])
-                self.last_texts[2] = self.texts[2]
+        self.program = program
+        self.loop = program.loop
+        self.program.interface.writer.on_error = lambda: self.loop.call_soon_threadsafe(self.watch_serial)
+        self.layout = Layout()
+        self.layout.set_stations(self.program.playlist.list)
+        self.serial_backoff = Config.serial_retry
+        DeviceWatcher(self.loop, Config.serial_dev, self.on_device)
+
+        # every piece of work below runs only when the serial port becomes
+        # readable or when one of the scheduled deadlines passes
+        self.watch_serial()
+        self.tick_clock()
+        self.watch_mpd()
+        self.report_stats()
+        if Config.trace:
+            self.flush_trace()
+        self.update_display()
+        PlaylistWatcher(self.loop, Config.playlist, self.apply_playlist)
+        self.alarm = AlarmScheduler(self.loop, self.program)
+        if self.program.prober is not None:
+            self.program.prober.on_update = self.update_display
+        self.program.mpd.on_reconnect = self.watch_mpd
+        if Config.control_port or Config.control_socket:
+            try:
+                self.control = ControlServer(self.loop, self.control_request)
+            except socket.error as e:
+                warning("control socket unavailable: " + str(e))
 
-            if self.texts[3] != self.last_texts[3]:
-                self.program.interface.try_write('S2:' + self.texts[3])
-                self.last_texts[3] = self.texts[3]
+        try:
+            self.loop.run()
+        finally:
+            self.program.state.flush()
+            self.program.history.flush()
+            for owner in (self.program.prober, self.program.watchdog):
+                if owner is not None and owner.store.timer is not None:
+                    owner.store.flush()
+            trace.flush()
+
+    def apply_playlist(self, playlist):
+        # keep the current station by its url, not by its index
+        old = self.program.playlist.list[self.program.active_song]
+        urls = [item.url for item in playlist.list]
+        if old.url in urls:
+            active = urls.index(old.url)
+        else:
+            active = min(self.program.active_song, len(urls) - 1)
+
+        moved = active != self.program.active_song
+        self.program.playlist = playlist
+        self.layout.set_stations(playlist.list)
+        self.program.active_song = active
+        self.program.last_active_song = active
+        if self.program.prober is not None:
+            self.program.prober.set_stations(playlist.list)
+        self.program.update_relay()
+        self.program.mpd.sync_playlist(self.program.stream_urls(playlist.list), active)
+        if moved:
+            self.program.state.update(active_menu=active)
+
+        interface = self.program.interface
+        interface.encoder = active
+        interface.stations = playlist.list
+        interface.max_value = len(playlist.list) - 1
+        interface.send_range()
+        info("playlist reloaded: %d stations, active %d" % (len(playlist.list), active))
+        trace.record('playlist', {'stations': len(playlist.list), 'active': active})
+
+        # D: clears the song rows on the firmware
+        self.last_rows = (None, None, None, None)
+        self.update_display()
+
+    def watch_serial(self):
+        fd = self.program.interface.fileno()
+        if fd == self.serial_fd:
+            if fd is None:
+                self.schedule_serial()
+            return
+        if self.serial_fd is not None:
+            self.loop.remove_reader(self.serial_fd)
+        self.serial_fd = fd
+        if fd is not None:
+            self.loop.add_reader(fd, self.on_serial)
+            self.serial_backoff = Config.serial_retry
+        else:
+            self.schedule_serial()
+
+    def schedule_serial(self, delay=None):
+        # while the board is away the port is retried with a growing delay,
+        # a matching device node showing up retries it right away
+        if self.serial_timer is not None:
+            return
+        if delay is None:
+            delay = self.serial_backoff
+            self.serial_backoff = min(self.serial_backoff * 2, Config.serial_retry_max)
+        self.serial_timer = self.loop.call_later(delay, self.retry_serial)
+
+    def on_device(self):
+        if self.program.interface.serial_connected:
+            return
+        self.loop.cancel(self.serial_timer)
+        self.serial_timer = None
+        self.serial_backoff = Config.serial_retry
+        # give udev time to set the permissions of the new node
+        self.schedule_serial(Config.serial_settle)
+
+    def retry_serial(self):
+        self.serial_timer = None
+        if self.program.interface.try_serial():
+            self.last_rows = (None, None, None, None)
+            self.update_display()
+        self.watch_serial()
+
+    def on_serial(self):
+        init_request = self.program.interface.try_read()
+        if init_request:
+            self.last_rows = (None, None, None, None)
+
+        interface = self.program.interface
+        if not 0 <= interface.encoder < len(self.program.playlist.list):
+            # the firmware still counts on the range from before a reload
+            # shrank the playlist, put it back on the active station
+            interface.encoder = self.program.active_song
+            interface.send_range()
+
+        if self.program.interface.encoder != self.program.active_song:
+            self.select_station(self.program.interface.encoder, self.switch_delay())
+
+        volume = self.program.interface.volume
+        if volume != self.program.active_volume:
+            # pot jitter, but the ends of the range are always reachable
+            if abs(volume - self.program.active_volume) >= Config.volume_hysteresis or volume in (self.program.interface.min_volume, self.program.interface.max_volume):
+                self.set_volume(volume)
+
+        if self.program.interface.alarm_hours != self.program.alarm_hours or self.program.interface.alarm_minutes != self.program.alarm_minutes or self.program.interface.alarm_on != self.program.alarm_on:
+            self.set_alarm(self.program.interface.alarm_hours, self.program.interface.alarm_minutes, self.program.interface.alarm_on)
+
+        self.update_display()
+        self.watch_serial()
+
+    def select_station(self, idx, delay):
+        self.program.active_song = idx
+        self.program.last_changed = self.program.millis()
+        self.loop.cancel(self.play_timer)
+        self.play_timer = self.loop.call_later(delay, self.play_station)
+        self.program.state.update(active_menu=idx)
+        self.publish({'event': 'station', 'index': idx, 'name': self.program.playlist.list[idx].name})
+
+    def set_alarm(self, hours, minutes, on):
+        self.program.alarm_hours = hours
+        self.program.alarm_minutes = minutes
+        self.program.alarm_on = on
+        self.program.state.update(alarm_hours=hours, alarm_minutes=minutes, alarm_on=on)
+        self.alarm.schedule()
+        self.publish({'event': 'alarm', 'hours': hours, 'minutes': minutes, 'on': on})
+
+    def set_volume(self, volume):
+        # setvol at most once per Config.volume_interval, a knob turned in
+        # between only moves the value the pending one sends
+        self.program.active_volume = volume
+        self.program.state.update(volume=volume)
+        self.publish({'event': 'volume', 'value': volume})
+        if self.volume_timer is None:
+            delay = self.last_setvol + Config.volume_interval - monotonic()
+            self.volume_timer = self.loop.call_later(max(0, delay), self.send_volume)
+
+    def send_volume(self):
+        self.volume_timer = None
+        self.last_setvol = monotonic()
+        self.program.mpd.setvol(self.program.active_volume)
+
+    def publish(self, event):
+        if self.control is not None:
+            self.control.publish(event)
+
+    def control_request(self, request):
+        # control socket commands, every answer carries the resulting status
+        interface = self.program.interface
+        cmd = request.get('cmd')
+        if cmd in ('station', 'next', 'prev'):
+            count = len(self.program.playlist.list)
+            if cmd == 'station':
+                idx = self.number(request, 'index')
+                if not 0 <= idx < count:
+                    raise ValueError("station index out of range: %d" % idx)
+            else:
+                idx = (self.program.active_song + (1 if cmd == 'next' else -1)) % count
+            if idx != self.program.active_song:
+                interface.set_encoder(idx)
+                self.select_station(idx, 0)
+        elif cmd == 'alarm':
+            hours = self.number(request, 'hours', self.program.alarm_hours)
+            minutes = self.number(request, 'minutes', self.program.alarm_minutes)
+            on = self.flag(request, 'on', self.program.alarm_on)
+            if not (0 <= hours < 24 and 0 <= minutes < 60):
+                raise ValueError("bad alarm time: %d:%d" % (hours, minutes))
+            interface.alarm_hours = hours
+            interface.alarm_minutes = minutes
+            interface.alarm_on = on
+            interface.send_alarm()
+            self.set_alarm(hours, minutes, on)
+        elif cmd == 'volume':
+            volume = self.number(request, 'value')
+            if not 0 <= volume <= 100:
+                raise ValueError("volume out of range: %d" % volume)
+            interface.volume = volume
+            self.set_volume(volume)
+        elif cmd == 'history':
+            return {'history': self.history(request), 'status': self.status()}
+        elif cmd not in ('status', 'subscribe', 'unsubscribe'):
+            raise ValueError("unknown command: %s" % cmd)
+        self.update_display()
+        return {'status': self.status()}
+
+    def number(self, request, key, default=None, kinds=(int, long)):
+        # json numbers as they came, 1e400 or "5" are refused, not converted
+        value = request.get(key, default)
+        if value is None and default is None:
+            raise ValueError("%s is required" % key)
+        if isinstance(value, bool) or not isinstance(value, kinds):
+            raise ValueError("%s must be an integer" % key if kinds == (int, long) else "%s must be a number" % key)
+        return value
+
+    def flag(self, request, key, default):
+        # json true or false only, "false" or 0 are refused, not converted
+        if key not in request:
+            return bool(default)
+        value = request[key]
+        if not isinstance(value, bool):
+            raise ValueError("%s must be true or false" % key)
+        return value
+
+    def history(self, request):
+        # station by playlist index or by name, times in unix seconds
+        station = request.get('station')
+        if isinstance(station, (int, long)) and not isinstance(station, bool):
+            if not 0 <= station < len(self.program.playlist.list):
+                raise ValueError("station index out of range: %d" % station)
+            station = self.program.playlist.list[station].name
+        elif station is not None and not isinstance(station, basestring):
+            raise ValueError("station must be an index or a name")
+        since = until = limit = None
+        if request.get('since') is not None:
+            since = self.number(request, 'since', kinds=(int, long, float))
+        if request.get('until') is not None:
+            until = self.number(request, 'until', kinds=(int, long, float))
+        if request.get('limit') is not None:
+            limit = self.number(request, 'limit')
+            if limit < 0:
+                raise ValueError("limit must not be negative")
+        entries = self.program.history.lookup(since, until, station, limit)
+        return [{'time': t, 'station': name, 'title': title} for t, name, title in entries]
+
+    def title_text(self):
+        # mpd hands out utf-8 byte strings
+        if isinstance(self.current_song, str):
+            return self.current_song.decode('utf-8', 'replace')
+        return self.current_song
+
+    def status(self):
+        program = self.program
+        return {
+            'station': program.active_song,
+            'name': program.playlist.list[program.active_song].name,
+            'playing': program.last_active_song,
+            'stations': len(program.playlist.list),
+            'title': self.title_text(),
+            'alarm': {'hours': program.alarm_hours, 'minutes': program.alarm_minutes, 'on': program.alarm_on},
+            'volume': program.active_volume,
+            'serial': program.interface.serial_connected,
+            'mpd': program.mpd.connected,
+        }
+
+    def switch_delay(self):
+        # a lone detent plays almost at once, during a spin the play waits
+        # until the encoder has been still for a few of its recent step gaps
+        now = monotonic()
+        gap = now - self.last_move
+        self.last_move = now
+        if gap >= Config.spin_gap:
+            self.step_gap = None
+            return Config.switch_delay
+        if self.step_gap is None:
+            self.step_gap = gap
+        else:
+            self.step_gap = (self.step_gap + gap) / 2
+        return min(Config.switch_settle, max(Config.spin_gap, 3 * self.step_gap))
+
+    def play_station(self):
+        self.play_timer = None
+        if self.program.last_active_song != self.program.active_song:
+            self.program.last_active_song = self.program.active_song
+            self.program.update_relay()
+            station = self.program.playlist.list[self.program.active_song]
+            if Config.probe_skip_dead and self.program.prober is not None and self.program.prober.is_dead(station):
+                # don't block mpd on a connect timeout, keep the last station playing
+                info("skipping dead station: " + station.url)
+            else:
+                self.program.mpd.play(self.program.active_song, self.program.stream_url(station))
+                if self.program.mpd.connected:
+                    metrics.encoder_time.observe((self.program.millis() - self.program.last_changed) / 1000.0)
+            self.program.state.update(last_played=int(time.time()))
+            self.update_display()
+
+    def tick_clock(self):
+        self.update_display()
+        # wake up again right after the next minute boundary
+        now = time.time()
+        self.loop.call_at(now - now % 60 + 60 + 0.01, self.tick_clock)
+
+    def watch_mpd(self):
+        # prefer mpd idle push notifications, fall back to polling every 500ms
+        self.last_idle_attempt = monotonic()
+        if self.mpd_fd is not None:
+            self.loop.remove_reader(self.mpd_fd)
+            self.mpd_fd = None
+        # polled until the idle connection is up
+        self.program.mpd.start_idle(self.idle_ready)
+        self.refresh_song()
+        if self.poll_timer is None:
+            self.poll_timer = self.loop.call_later(Config.poll_delay, self.poll_song)
+
+    def idle_ready(self, fd):
+        if fd is None:
+            return
+        self.mpd_fd = fd
+        self.loop.add_reader(fd, self.on_mpd)
+        self.loop.cancel(self.poll_timer)
+        self.poll_timer = None
+
+    def on_mpd(self):
+        changes = self.program.mpd.fetch_idle()
+        if changes is None:
+            self.loop.remove_reader(self.mpd_fd)
+            self.mpd_fd = None
+            self.poll_timer = self.loop.call_later(Config.poll_delay, self.poll_song)
+            return
+        debug("mpd changed: " + ", ".join(changes))
+        trace.record('idle', changes)
+        if 'player' in changes and self.program.watchdog is not None:
+            self.program.watchdog.wake()
+        if 'player' in changes or 'playlist' in changes:
+            self.refresh_song()
+
+    def poll_song(self):
+        self.poll_timer = None
+        if monotonic() - self.last_idle_attempt >= Config.idle_retry:
+            self.watch_mpd()
+            return
+        if self.program.watchdog is not None:
+            self.program.watchdog.wake()
+        self.refresh_song()
+        self.poll_timer = self.loop.call_later(Config.poll_delay, self.poll_song)
+
+    def refresh_song(self):
+        current_song = self.program.mpd.currentsong()
+        if current_song is None:
+            # mpd is reconnecting, keep what is on screen
+            return
+
+        title = ''
+        if current_song is not None and current_song != '' and 'title' in current_song[0]:
+            title = current_song[0]['title'].strip()
+
+        if title != self.current_song:
+            self.current_song = title
+            trace.record('title', title)
+            self.publish({'event': 'title', 'title': self.title_text()})
+            if title:
+                self.program.history.add(self.program.playlist.list[self.program.last_active_song].name, self.title_text())
+            self.song_frames = self.layout.title_frames(title)
+            self.frame = 0
+            self.loop.cancel(self.marquee_timer)
+            self.marquee_timer = None
+            if len(self.song_frames) > 1:
+                self.marquee_timer = self.loop.call_later(Config.marquee_delay, self.scroll_song)
+
+        self.update_display()
+
+    def scroll_song(self):
+        self.frame = (self.frame + 1) % len(self.song_frames)
+        self.marquee_timer = self.loop.call_later(Config.marquee_delay, self.scroll_song)
+        self.update_display()
+
+    def report_stats(self):
+        info("loop: " + str(self.loop.wakeups_per_minute()) + " wakeups/min")
+        info("mpd: " + str(self.program.mpd.round_trips_saved()) + " round trips saved by idle")
+        info("mpd: " + str(self.program.mpd.reconnects) + " reconnects")
+        info("state: " + str(self.program.state.writes) + " writes, " + str(self.program.state.writes_saved()) + " saved")
+        self.loop.call_later(Config.stats_interval, self.report_stats)
+
+    def flush_trace(self):
+        # a trace is most wanted after a crash or a power cut, not only on a
+        # clean exit
+        trace.flush()
+        self.loop.call_later(Config.trace_flush, self.flush_trace)
+
+    def update_display(self):
+        song = self.song_frames[self.frame]
+        # the song rows belong to the station still playing, not to the
+        # one the encoder points at
+        pending = self.program.active_song != self.program.last_active_song
+        if pending:
+            song = ('', '')
+        if (pending or not self.current_song) and self.program.prober is not None:
+            if self.program.prober.is_dead(self.program.playlist.list[self.program.active_song]):
+                song = ('', 'OFFLINE')
+        rows = (self.layout.station(self.program.active_song), song[0], song[1], datetime.now().strftime("%H:%M"))
+
+        if rows != self.last_rows:
+            for slot, text, last in zip(('S0', 'S1', 'S2', 'TM'), rows, self.last_rows):
+                if text != last:
+                    self.program.interface.try_write(slot + ':' + text)
+            self.last_rows = rows
+
+        self.watch_serial()
+
+
+def write_atomic(filename, content):
+    # write a temp file and rename it over the old one, so a power cut
+    # leaves either the old or the new content, never an empty file
+    tmp = filename + ".tmp"
+    fdst = open(tmp, "w")
+    try:
+        fdst.write(content)
+        fdst.flush()
+        os.fsync(fdst.fileno())
+    finally:
+        fdst.close()
+    os.rename(tmp, filename)
+    fdir = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+    try:
+        os.fsync(fdir)
+    finally:
+        os.close(fdir)
+
+
+class JsonIndex:
+
+    # {url: record} in a json file. Like State, changes within
+    # Config.state_window are merged into a single atomic write
+
+    def __init__(self, filename, name, loop=None):
+        self.filename = filename
+        self.name = name
+        self.loop = loop
+        self.data = {}
+        self.timer = None
+        self.writes = 0
+        self.load()
 
-            time.sleep(Config.read_delay)
+    def load(self):
+        try:
+            fsrc = open(self.filename, "r")
+            self.data = json.load(fsrc)
+            fsrc.close()
+        except (IOError, ValueError) as e:
+            self.data = {}
+
+    def changed(self):
+        if self.loop is None:
+            self.flush()
+        elif self.timer is None:
+            self.timer = self.loop.call_later(Config.state_window, self.flush)
+
+    def flush(self):
+        if self.loop is not None:
+            self.loop.cancel(self.timer)
+        self.timer = None
+        try:
+            write_atomic(self.filename, json.dumps(self.data))
+            self.writes += 1
+        except (IOError, OSError) as e:
+            warning("Unable to store %s: %s" % (self.name, e))
 
 
 class State:
 
+    # the first line of the state file keeps the original colon separated
+    # fields, any other value is stored as a key=value line below it
+    legacy = ('active_menu', 'alarm_hours', 'alarm_minutes', 'alarm_on')
+
     active_menu = 0
     alarm_hours = 0
     alarm_minutes = 0
     alarm_on = False
 
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.extra = collections.OrderedDict()
+        self.written = None
+        self.timer = None
+        self.updates = 0
+        self.writes = 0
+
     def load(self):
         try:
-            result = 0
             fsrc = codecs.open(Config.state, mode="r", encoding="utf-8")
             ln = fsrc.readline().strip()
             if ln != "":
@@ -434,75 +2978,344 @@ class State:
                 self.alarm_minutes = int(parts[2])
                 if (parts[3] == '1'):
                     self.alarm_on = True
+            for ln in fsrc:
+                key, sep, value = ln.strip().partition("=")
+                if sep:
+                    self.extra[key] = value
             fsrc.close()
+            self.written = self.serialize()
             return True
         except Exception as e:
-            debug("Unable to load state: " + e.message)
+            warning("Unable to load state: " + str(e))
             return False
 
-    def save(self, active_menu, alarm_hours, alarm_minutes, alarm_on):
+    def get(self, key, default=None):
+        if key in self.legacy:
+            return getattr(self, key)
+        if key not in self.extra:
+            return default
         try:
-            fsrc = codecs.open(Config.state, mode="w", encoding="utf-8")
-            fsrc.write(str(active_menu))
-            fsrc.write(':')
-            fsrc.write(str(alarm_hours))
-            fsrc.write(':')
-            fsrc.write(str(alarm_minutes))
-            fsrc.write(':')
-            if (alarm_on):
-                fsrc.write('1')
+            if default is None:
+                return self.extra[key]
+            return type(default)(self.extra[key])
+        except ValueError:
+            return default
+
+    def update(self, **values):
+        # changes within Config.state_window are merged into a single write
+        for key, value in values.items():
+            if key in self.legacy:
+                setattr(self, key, value)
             else:
-                fsrc.write('0')
-            fsrc.close()
-        except Exception as e:
-            debug("Unable to store state: " + e.message)
+                self.extra[key] = str(value)
+        self.updates += 1
+        if self.loop is None:
+            self.flush()
+        elif self.timer is None:
+            self.timer = self.loop.call_later(Config.state_window, self.flush)
+
+    def save(self, active_menu, alarm_hours, alarm_minutes, alarm_on):
+        self.update(active_menu=active_menu, alarm_hours=alarm_hours, alarm_minutes=alarm_minutes, alarm_on=alarm_on)
+
+    def writes_saved(self):
+        return self.updates - self.writes
+
+    def serialize(self):
+        lines = ["%d:%d:%d:%d" % (int(self.active_menu), int(self.alarm_hours), int(self.alarm_minutes), 1 if self.alarm_on else 0)]
+        for key, value in self.extra.items():
+            lines.append("%s=%s" % (key, value))
+        return "\n".join(lines) + "\n"
+
+    def flush(self):
+        if self.loop is not None:
+            self.loop.cancel(self.timer)
+        self.timer = None
+        content = self.serialize()
+        if content == self.written:
+            return
+        try:
+            write_atomic(Config.state, content)
+            self.written = content
+            self.writes += 1
+        except (IOError, OSError) as e:
+            warning("Unable to store state: " + str(e))
 
 
-class PlaylistItem:
+class SongHistory:
+
+    # the last Config.history_size titles in memory, indexed by time and by
+    # station, and an append-only log of all of them. The log is written by
+    # its own thread in batches, one fsync per Config.history_sync seconds
+    # at most, and rotated at Config.history_bytes
 
     def __init__(self):
-        self.name = None
-        self.url = None
-        self.payload = []
+        self.entries = collections.deque()
+        self.times = collections.deque()
+        self.stations = {}
+        self.cond = threading.Condition()
+        self.pending = []
+        self.write_lock = threading.Lock()
+        self.last_sync = 0
+        self.writes = 0
+        self.syncs = 0
+        self.thread = None
+
+    def load(self):
+        # the tail of the current log fills the ring after a restart
+        if not Config.history:
+            return
+        tail = collections.deque(maxlen=Config.history_size)
+        try:
+            fsrc = open(Config.history, "rb")
+            try:
+                for ln in fsrc:
+                    tail.append(ln)
+            finally:
+                fsrc.close()
+        except IOError:
+            return
+        for ln in tail:
+            entry = self.parse(ln)
+            if entry is not None:
+                self.remember(entry)
+
+    def parse(self, ln):
+        parts = ln.rstrip("\n").split("\t", 2)
+        if len(parts) != 3:
+            return None
+        try:
+            return (int(parts[0]), parts[1].decode('utf-8', 'replace'), parts[2].decode('utf-8', 'replace'))
+        except ValueError:
+            return None
+
+    def add(self, station, title, now=None):
+        entry = (int(now or time.time()), station, title)
+        if self.entries:
+            if self.entries[-1][1:] == entry[1:]:
+                return
+            # the lookup bisects by time, a clock stepped back by ntp must
+            # not break the order
+            if entry[0] < self.entries[-1][0]:
+                entry = (self.entries[-1][0],) + entry[1:]
+        self.remember(entry)
+        if not Config.history:
+            return
+        with self.cond:
+            self.pending.append(self.format(entry))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="history-writer")
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+
+    def remember(self, entry):
+        if len(self.entries) >= Config.history_size:
+            old = self.entries.popleft()
+            self.times.popleft()
+            same = self.stations[old[1]]
+            same.popleft()
+            if not same:
+                del self.stations[old[1]]
+        self.entries.append(entry)
+        self.times.append(entry[0])
+        self.stations.setdefault(entry[1], collections.deque()).append(entry)
+
+    def format(self, entry):
+        fields = [unicode(field).replace(u"\t", u" ").replace(u"\n", u" ") for field in entry]
+        return (u"\t".join(fields) + u"\n").encode('utf-8')
+
+    def lookup(self, since=None, until=None, station=None, limit=None):
+        # newest first
+        if station is not None:
+            entries = self.stations.get(station, ())
+            times = [entry[0] for entry in entries]
+        else:
+            entries = self.entries
+            times = self.times
+        low = 0 if since is None else bisect.bisect_left(times, since)
+        high = len(times) if until is None else bisect.bisect_right(times, until)
+        found = [entries[idx] for idx in range(high - 1, low - 1, -1)]
+        if limit is not None:
+            found = found[:limit]
+        return found
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+            # let titles gather until the next fsync is due
+            delay = self.last_sync + Config.history_sync - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.flush()
+
+    def flush(self):
+        # from the writer thread, and from the main thread on exit
+        with self.write_lock:
+            with self.cond:
+                lines = self.pending
+                self.pending = []
+            if lines:
+                self.write("".join(lines), len(lines))
+
+    def write(self, data, count):
+        try:
+            self.rotate(len(data))
+            fdst = open(Config.history, "ab")
+            try:
+                fdst.write(data)
+                fdst.flush()
+                os.fsync(fdst.fileno())
+            finally:
+                fdst.close()
+            self.writes += count
+            self.syncs += 1
+        except (IOError, OSError) as e:
+            warning("Unable to write history: " + str(e))
+        self.last_sync = monotonic()
+
+    def rotate(self, size):
+        try:
+            current = os.path.getsize(Config.history)
+        except OSError:
+            return
+        if current + size <= Config.history_bytes:
+            return
+        for idx in range(Config.history_keep - 1, 0, -1):
+            older = "%s.%d" % (Config.history, idx)
+            if os.path.exists(older):
+                os.rename(older, "%s.%d" % (Config.history, idx + 1))
+        if Config.history_keep > 0:
+            os.rename(Config.history, Config.history + ".1")
+        else:
+            os.unlink(Config.history)
+
+
+class PlaylistItem(object):
+
+    __slots__ = ('name', 'url', 'alternates')
+
+    def __init__(self, name=None, url=None, alternates=()):
+        self.name = name
+        self.url = url
+        self.alternates = alternates
 
 
 class Playlist:
 
     list = []
 
+    # bump when the cached item layout changes
+    cache_version = 1
+
     def __init__(self):
         self.list = []
 
     def load(self, filename):
         try:
-            fsrc = codecs.open(filename, mode="r", encoding="utf-8")
-            self.parse(fsrc)
-            fsrc.close()
+            stamp = self.stamp(filename)
+            items = self.load_cache(stamp)
+            if items is None:
+                fsrc = codecs.open(filename, mode="r", encoding="utf-8")
+                self.parse(fsrc)
+                fsrc.close()
+                self.save_cache(stamp)
+            else:
+                self.list = items
         except Exception as e:
-            debug("Error while loading playlist: " + e.message)
+            warning("Error while loading playlist: " + str(e))
 
-    def parse(self, infile):
-        ln = None
-        self.list = []
+    def peek(self, filename, index):
+        # parse only up to the entry at index, unless the cache is fresh
+        items = []
+        try:
+            items = self.load_cache(self.stamp(filename))
+            if items is None:
+                fsrc = codecs.open(filename, mode="r", encoding="utf-8")
+                self.parse(fsrc, index + 1)
+                fsrc.close()
+                items = self.list
+                self.list = []
+        except Exception as e:
+            warning("Error while reading playlist: " + str(e))
+        if index < len(items):
+            return items[index]
+        return None
+
+    def stamp(self, filename):
+        st = os.stat(filename)
+        # full float times and the inode: a same-size edit within the same
+        # second, or a new file renamed over the old one, still misses
+        return (self.cache_version, st.st_mtime, st.st_ctime, st.st_ino, st.st_size)
+
+    def load_cache(self, stamp):
+        if not Config.playlist_cache:
+            return None
+        try:
+            fsrc = open(Config.playlist_cache, "rb")
+            try:
+                cached_stamp, rows = marshal.load(fsrc)
+            finally:
+                fsrc.close()
+        except (IOError, EOFError, ValueError, TypeError) as e:
+            return None
+        if cached_stamp != stamp:
+            return None
+        return [PlaylistItem(*row) for row in rows]
 
-        while ln != "" and ln != u"#EXTM3U\n":
-            ln = infile.readline()
-
-        ln = infile.readline()
-        while ln != "":
-            while ln != "" and ln.find(u"#EXTINF") == -1:
-                ln = infile.readline()
-            match = re.search(ur"#EXTINF:.*,(.*)", ln)
-            name = match.group(1)
-            nitem = PlaylistItem()
-            nitem.name = name
-            ln = infile.readline()
-            while ln != "" and ln.find(u"#EXTINF") == -1:
-                nitem.payload.append(ln)
-                ln = infile.readline()
-            nitem.url = nitem.payload[-1].strip()
-            self.list.append(nitem)
+    def save_cache(self, stamp):
+        if not Config.playlist_cache:
+            return
+        rows = [(item.name, item.url, item.alternates) for item in self.list]
+        tmp = Config.playlist_cache + ".tmp"
+        try:
+            fdst = open(tmp, "wb")
+            marshal.dump((stamp, rows), fdst)
+            fdst.close()
+            os.rename(tmp, Config.playlist_cache)
+        except (IOError, OSError) as e:
+            warning("Unable to store playlist cache: " + str(e))
+
+    def parse(self, infile, limit=None):
+        self.list = []
+        for item in self.iter_items(infile):
+            self.list.append(item)
+            if limit is not None and len(self.list) >= limit:
+                break
+
+    def iter_items(self, infile):
+        # single pass: #EXTINF starts an entry, the url lines following it are
+        # its mirrors (the last one is the primary url), comments and junk are skipped
+        name = None
+        urls = []
+        for ln in infile:
+            ln = ln.strip()
+            if ln.startswith(u"#EXTINF"):
+                if name is not None and urls:
+                    yield PlaylistItem(name, urls[-1], tuple(urls[:-1]))
+                comma = ln.find(u",")
+                if comma == -1:
+                    name = u""
+                else:
+                    name = ln[comma + 1:].strip()
+                urls = []
+            elif ln == u"" or ln.startswith(u"#"):
+                continue
+            elif u"://" not in ln and not ln.startswith(u"/"):
+                debug("playlist: skipping " + ln)
+                continue
+            elif name is None:
+                # bare url without #EXTINF, as in plain directory dumps
+                yield PlaylistItem(ln, ln)
+            else:
+                urls.append(ln)
+        if name is not None and urls:
+            yield PlaylistItem(name, urls[-1], tuple(urls[:-1]))
 
 
 if __name__ == '__main__':
+    # let systemd stop us through the normal exit path, so pending state is written
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    setup_logging()
     Program()
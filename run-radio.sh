@@ -1,5 +1,6 @@
 #!/bin/bash
 
 cd /home/pi/PiRadio
-#exec python2 -u run-radio.py > /home/pi/PiRadio/logs/radio.log 2>&1
-exec python2 -u run-radio.py > /dev/null 2>&1
+mkdir -p logs
+# the daemon writes its own rotated log to logs/radio.log, keep crash tracebacks
+exec python2 -u run-radio.py > /dev/null 2>> /home/pi/PiRadio/logs/radio.err
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+# AlarmScheduler.fire and the volume ramp against stub mpd and loop objects.
+
+import os
+import imp
+import logging
+import unittest
+from datetime import datetime
+
+radio = imp.load_source('radio', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'run-radio.py'))
+logging.getLogger('radio').addHandler(logging.NullHandler())
+
+
+class StubLoop:
+
+    def __init__(self):
+        self.timers = []
+
+    def call_later(self, delay, callback):
+        self.timers.append(callback)
+        return callback
+
+    def cancel(self, timer):
+        if timer in self.timers:
+            self.timers.remove(timer)
+
+
+class StubMPD:
+
+    def __init__(self, state):
+        self.state = state
+        self.commands = []
+
+    def status(self):
+        return {'state': self.state}
+
+    def setvol(self, volume):
+        self.commands.append(('setvol', volume))
+
+    def play(self, idx):
+        self.commands.append(('play', idx))
+        self.state = 'play'
+
+
+class StubProgram:
+
+    def __init__(self, state, volume):
+        self.mpd = StubMPD(state)
+        self.active_volume = volume
+        self.active_song = 2
+        self.alarm_on = False
+        self.powered = 0
+        self.interface = self
+        self.state = self
+
+    def power_on(self):
+        self.powered += 1
+
+    def get(self, key, default=None):
+        return default
+
+    def update(self, **values):
+        pass
+
+
+class AlarmTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (radio.Config.alarm_ramp, radio.Config.alarm_volume, radio.monotonic)
+        radio.Config.alarm_ramp = 30
+        radio.Config.alarm_volume = 40
+        self.now = 1000.0
+        radio.monotonic = lambda: self.now
+
+    def tearDown(self):
+        radio.Config.alarm_ramp, radio.Config.alarm_volume, radio.monotonic = self.saved
+
+    def fire(self, state, volume):
+        loop = StubLoop()
+        program = StubProgram(state, volume)
+        alarm = radio.AlarmScheduler(loop, program)
+        alarm.fire(datetime(2026, 1, 1, 7, 0))
+        # one tick per second, as the loop would run them
+        ticks = 0
+        while loop.timers and ticks < 100:
+            self.now += 1
+            loop.timers.pop(0)()
+            ticks += 1
+        return program, ticks
+
+    def volumes(self, program):
+        return [value for command, value in program.mpd.commands if command == 'setvol']
+
+    def test_unknown_knob_position_still_wakes_up(self):
+        # protocol 1 firmware never reports the knob, active_volume stays 0
+        program, ticks = self.fire('stop', 0)
+        self.assertEqual(program.mpd.commands[:2], [('setvol', 0), ('play', 2)])
+        self.assertEqual(self.volumes(program)[-1], 40)
+        self.assertEqual(program.powered, 1)
+
+    def test_ramp_ends_after_alarm_ramp_seconds(self):
+        program, ticks = self.fire('stop', 90)
+        volumes = self.volumes(program)
+        self.assertEqual(ticks, 30)
+        self.assertEqual(volumes[-1], 90)
+        self.assertEqual(volumes, sorted(volumes))
+        self.assertEqual(volumes[16], 45)
+
+    def test_playing_station_is_not_muted(self):
+        program, ticks = self.fire('play', 60)
+        self.assertNotIn(('play', 2), program.mpd.commands)
+        self.assertEqual(min(self.volumes(program)), 60)
+
+
+if __name__ == '__main__':
+    unittest.main()
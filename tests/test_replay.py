@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+# bench/replay.py trace loading and the fake MPD it drives, on the fixture
+# traces in bench/fixtures.
+
+import os
+import sys
+import imp
+import unittest
+
+from mpd import MPDClient
+
+BENCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench')
+sys.path.insert(0, BENCH_DIR)
+replay = imp.load_source('replay', os.path.join(BENCH_DIR, 'replay.py'))
+from fakempd import FakeMPD
+
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mpd = FakeMPD()
+        self.mpd.start()
+        self.mpd.queue.append((1, "http://127.0.0.1:9/station/0000"))
+        self.mpd.current = 1
+        self.client = MPDClient()
+        self.client.connect("127.0.0.1", self.mpd.port)
+
+    def tearDown(self):
+        self.client.disconnect()
+        self.mpd.stop()
+
+    def test_non_ascii_titles_reach_the_client(self):
+        stations, active, protocol, inputs, round_trips = replay.load_trace(os.path.join(BENCH_DIR, 'fixtures', 'cyrillic-titles.jsonl'))
+        titles = [value for t, kind, value in inputs if kind == 'title']
+        self.assertEqual(len(titles), 3)
+        self.assertEqual(protocol, 2)
+        self.assertTrue(round_trips['currentsong'])
+        for title in titles:
+            self.mpd.set_title(title)
+            self.assertEqual(self.client.currentsong()['title'], title.encode('utf-8'))
+
+
+if __name__ == '__main__':
+    unittest.main()
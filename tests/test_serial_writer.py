@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+# SerialWriter against a stub port: what goes out on the wire, in which order.
+#   python2 -m unittest discover -s tests
+
+import os
+import imp
+import time
+import threading
+import logging
+import unittest
+
+radio = imp.load_source('radio', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'run-radio.py'))
+logging.getLogger('radio').addHandler(logging.NullHandler())
+
+
+class StubPort:
+
+    # stands in for Interface: records whole lines, acks frames unless told
+    # to stay silent
+
+    def __init__(self, protocol=2, ack=True):
+        self.protocol = protocol
+        self.ack = ack
+        self.writer = None
+        self.buffer = ""
+        self.lines = []
+        self.cond = threading.Condition()
+
+    def write(self, data):
+        self.buffer += data
+        while "\r\n" in self.buffer:
+            line, self.buffer = self.buffer.split("\r\n", 1)
+            with self.cond:
+                self.lines.append(line)
+                self.cond.notify_all()
+            if line.startswith("#") and self.ack:
+                self.writer.ack(int(line[1:3], 16), True)
+        return True
+
+    def wait_lines(self, count, timeout=5):
+        deadline = time.time() + timeout
+        with self.cond:
+            while len(self.lines) < count and time.time() < deadline:
+                self.cond.wait(0.05)
+            return list(self.lines)
+
+
+def payload(line):
+    # #SSpayload*CK -> payload
+    return line[3:line.rindex("*")] if line.startswith("#") else line
+
+
+class SerialWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (radio.Config.serial_rate, radio.Config.serial_burst, radio.Config.ack_timeout, radio.Config.ack_retries)
+        radio.Config.serial_rate = 1000000
+        radio.Config.serial_burst = 1024
+
+    def tearDown(self):
+        radio.Config.serial_rate, radio.Config.serial_burst, radio.Config.ack_timeout, radio.Config.ack_retries = self.saved
+
+    def writer(self, port):
+        writer = radio.SerialWriter(port)
+        port.writer = writer
+        return writer
+
+    def test_range_goes_out_before_the_rows_queued_after_it(self):
+        port = StubPort()
+        writer = self.writer(port)
+        with writer.cond:
+            writer.put("D:3:10")
+            writer.put("S1:Artist")
+            writer.put("S2:Song")
+        lines = [payload(line) for line in port.wait_lines(2)]
+        self.assertEqual(lines, ["D:3:10", "U:|Artist|Song|"])
+
+    def test_rows_behind_a_range_get_a_frame_of_their_own(self):
+        # the clock row queued first goes ahead of D:, the song rows queued
+        # behind it must not ride along and get cleared by it
+        port = StubPort()
+        writer = self.writer(port)
+        with writer.cond:
+            writer.put("TM:07:00")
+            writer.put("D:3:10")
+            writer.put("S1:Artist")
+        lines = [payload(line) for line in port.wait_lines(3)]
+        self.assertEqual(lines[1], "D:3:10")
+        self.assertEqual(lines[2], "U:|Artist||07:00")
+
+    def test_unacked_payload_is_resent_after_the_fallback(self):
+        radio.Config.ack_timeout = 0.02
+        radio.Config.ack_retries = 2
+        port = StubPort(ack=False)
+        writer = self.writer(port)
+        writer.put("PW:1")
+        lines = port.wait_lines(3)
+        self.assertEqual([payload(line) for line in lines[:2]], ["PW:1", "PW:1"])
+        self.assertEqual(lines[2], "PW:1")
+        self.assertEqual(port.protocol, 1)
+
+    def test_newer_value_wins_over_the_unacked_one(self):
+        radio.Config.ack_timeout = 0.05
+        radio.Config.ack_retries = 1
+        port = StubPort(ack=False)
+        writer = self.writer(port)
+        writer.put("ST:4")
+        port.wait_lines(1)
+        writer.put("ST:5")
+        lines = port.wait_lines(2)
+        time.sleep(0.1)
+        self.assertEqual(lines[1], "ST:5")
+        self.assertEqual(port.lines[2:], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
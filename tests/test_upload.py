@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+# ino upload (ino/configs/ino/commands/upload.py) against a stub avrdude:
+# skip of an unchanged image, --force, --verify and forget() on failure.
+
+import os
+import sys
+import imp
+import json
+import shutil
+import tempfile
+import unittest
+import argparse
+
+try:
+    import ino.commands.base
+    import ino.exc
+except ImportError:
+    # ino itself is only installed on the build host, the command needs no
+    # more of it than these two names
+    class Command(object):
+        pass
+
+    class Abort(Exception):
+        pass
+
+    for name in ('ino', 'ino.commands', 'ino.commands.base', 'ino.exc'):
+        sys.modules[name] = imp.new_module(name)
+    sys.modules['ino.commands.base'].Command = Command
+    sys.modules['ino.exc'].Abort = Abort
+
+upload = imp.load_source('ino_upload', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ino', 'configs', 'ino', 'commands', 'upload.py'))
+
+STUB = """#!/bin/sh
+echo "$@" >> "%(dir)s/calls"
+exit $(cat "%(dir)s/exit")
+"""
+
+# sudo in front of avrdude just runs it
+SUDO = """#!/bin/sh
+exec "$@"
+"""
+
+BOARD = {
+    'upload': {'protocol': 'arduino'},
+    'bootloader': {'path': 'optiboot'},
+    'build': {'mcu': 'atmega328p'},
+}
+
+
+class StubEnvironment(dict):
+
+    def find_tool(self, *args):
+        pass
+
+    find_arduino_tool = find_arduino_file = find_tool
+
+    def guess_serial_port(self):
+        return '/dev/ttyAMA0'
+
+    def board_model(self, name):
+        return BOARD
+
+
+class UploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.script('avrdude', STUB % {'dir': self.dir})
+        self.script('sudo', SUDO)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = self.dir + os.pathsep + self.path
+        self.hex = os.path.join(self.dir, 'firmware.hex')
+        with open(self.hex, 'w') as f:
+            f.write(':00000001FF\n')
+        self.command = upload.Upload.__new__(upload.Upload)
+        self.command.e = StubEnvironment({
+            'avrdude': os.path.join(self.dir, 'avrdude'),
+            'avrdude.conf': os.path.join(self.dir, 'avrdude.conf'),
+            'hex_path': self.hex,
+        })
+        self.record = os.path.join(self.dir, 'last-flash.json')
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.dir)
+
+    def script(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        os.chmod(path, 0755)
+
+    def run_upload(self, exit=0, force=False, verify=False):
+        with open(os.path.join(self.dir, 'exit'), 'w') as f:
+            f.write(str(exit))
+        args = argparse.Namespace(serial_port=None, board_model=None, force=force, verify=verify)
+        self.command.run(args)
+
+    def calls(self):
+        try:
+            with open(os.path.join(self.dir, 'calls')) as f:
+                return [line.split()[-1].split(':')[1] for line in f]
+        except IOError:
+            return []
+
+    def test_unchanged_image_is_skipped(self):
+        self.run_upload()
+        self.assertTrue(os.path.exists(self.record))
+        self.run_upload()
+        self.assertEqual(self.calls(), ['w'])
+
+    def test_changed_image_is_written(self):
+        self.run_upload()
+        with open(self.hex, 'a') as f:
+            f.write(':00000001FF\n')
+        self.run_upload()
+        self.assertEqual(self.calls(), ['w', 'w'])
+
+    def test_force_writes_an_unchanged_image(self):
+        self.run_upload()
+        self.run_upload(force=True)
+        self.assertEqual(self.calls(), ['w', 'w'])
+
+    def test_failed_write_forgets_the_last_flash(self):
+        self.run_upload()
+        self.assertRaises(upload.Abort, self.run_upload, exit=1, force=True)
+        self.assertFalse(os.path.exists(self.record))
+        # so the next plain upload writes again
+        self.run_upload()
+        self.assertEqual(self.calls(), ['w', 'w', 'w'])
+
+    def test_verify_records_a_match_and_forgets_a_mismatch(self):
+        self.run_upload(verify=True)
+        with open(self.record) as f:
+            self.assertEqual(json.load(f)['mcu'], 'atmega328p')
+        self.assertRaises(upload.Abort, self.run_upload, exit=1, verify=True)
+        self.assertFalse(os.path.exists(self.record))
+        self.assertEqual(self.calls(), ['v', 'v'])
+
+
+if __name__ == '__main__':
+    unittest.main()